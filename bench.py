@@ -0,0 +1,1090 @@
+"""
+Replays a synthetic stream of Telegram updates through the bot's registered handlers and reports how each
+command holds up. Runs against a throwaway database with outgoing messages swallowed, so nothing reaches Telegram.
+
+    python bench.py --users 500 --bounties 20 --updates 20000
+    python bench.py --save-baseline             # remember this run's numbers
+    python bench.py --baseline bench_baseline.json --tolerance 0.25   # exit 1 if a command got slower
+
+Other modes measure one thing each, or check one thing and exit 1 if it doesn't hold:
+
+    python bench.py commit --threads 32         # commands/s committing each command alone vs group commit
+    python bench.py lookup --history 1000000    # name and ID lookups stay flat as ended bounties pile up
+    python bench.py log --rows 10000000         # /showlog pages on a 10M-row log
+    python bench.py startup --history 500000    # startup time and RSS don't grow with ended bounties
+    python bench.py records --size 100000       # bytes per user and bounty record against plain dicts
+    python bench.py parse                       # tokenizing and parsing real command texts, then and now
+    python bench.py bulk --size 1000            # one N-user /grant and CSV /cashout against N single /grants
+    python bench.py archive                     # balances stay right after archiving the whole log
+    python bench.py stress --updates 20000      # concurrent handlers, cashouts included, lose no shares
+    python bench.py webhook --workers 3 --chats 6   # replayed updates through webhook workers apply once each
+    python bench.py webhook --update-log redis  # the same, remembering updates in a stand-in Redis (needs redis-py)
+    python bench.py transport --chats 50        # sync vs async reply latency against a fake Telegram
+    python bench.py pacing --chats 3            # 429s, rate limits, coalescing and 400s against a fake Telegram
+"""
+import argparse
+import contextlib
+import http.client
+import http.server
+import json
+import os
+import random
+import re
+import shlex
+import signal
+import socket
+import socketserver
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('API_KEY_TG', '0:bench')  # Never used to reach Telegram, but telebot checks its shape
+
+import telebot
+import thugs_bot as tb
+
+admin_id = 0  # Sends the admin commands; registered users are 1..--users
+default_mix = 'bump=40,onthejob=20,leaderboard=15,showlog=10,bountylist=15'
+write_mix = 'bump=60,onthejob=25,abandon=15'
+
+clock = threading.local()  # Per thread: seconds spent in persist() and read_query() for the current update
+update_ids = iter(range(1, sys.maxsize))
+
+def timed_sqlite(f):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            clock.sqlite = getattr(clock, 'sqlite', 0) + time.perf_counter() - started
+
+    return wrapper
+
+class Document:
+    def __init__(self, content):
+        self.file_id = 'bench.csv'
+        self.file_size = len(content)
+
+def make_document(chat_id, caption, content):
+    # A CSV sent with a caption; the bot's download is pointed at content
+    message = make_update(chat_id, admin_id, caption).message
+    message.text, message.caption, message.content_type = None, caption, 'document'
+    message.document = Document(content)
+    tb.bot.get_file = lambda file_id: type('File', (), {'file_path': file_id})
+    tb.bot.download_file = lambda path: content
+
+    return message
+
+def make_update(chat_id, user_id, text):
+    return telebot.types.Update.de_json(update_json(chat_id, user_id, text))
+
+def update_json(chat_id, user_id, text):
+    # The update as Telegram would send it
+    username = 'admin' if user_id == admin_id else f"user{user_id}"
+    command_length = len(text.split()[0])
+
+    update_id = next(update_ids)
+
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': tb.now(),
+            'chat': {'id': chat_id, 'type': 'supergroup'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+        }
+    }
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+
+    return weights
+
+def build_stream(args):
+    # Setup (registrations, bounties) comes first and isn't measured; the mixed stream after it is
+    chats = [-1000 - i for i in range(args.chats)]
+    setup = []
+    for chat_id in chats:
+        setup.append(make_update(chat_id, admin_id, '/register'))
+        setup += [make_update(chat_id, user_id, '/register') for user_id in range(1, args.users + 1)]
+        setup += [make_update(chat_id, admin_id, f'/addbounty job{i} {args.users} 10000') for i in range(args.bounties)]
+
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    names = list(weights)
+    stream = []
+
+    for name in rng.choices(names, weights=[weights[name] for name in names], k=args.updates):
+        chat_id = rng.choice(chats)
+        user_id = rng.randint(1, args.users)
+        bounty = f'job{rng.randrange(args.bounties)}' if args.bounties else 'nothing'
+
+        if name == 'bump':
+            text = f'/bump @user{user_id % args.users + 1}'
+        elif name in ('onthejob', 'abandon'):
+            text = f'/{name} {bounty}'
+        elif name == 'showlog':
+            text, user_id = f'/showlog @user{user_id}', admin_id
+        elif name == 'leaderboard':
+            text = '/leaderboard' if rng.random() < 0.5 else f'/leaderboard top {rng.randint(1, 20)}'
+        else:
+            text = f'/{name}'
+
+        stream.append(make_update(chat_id, user_id, text))
+
+    return setup, stream
+
+def handlers():
+    table = {}
+    for handler in tb.bot.message_handlers:
+        for name in handler['filters'].get('commands', []):
+            table[name] = handler['function']
+
+    return table
+
+def handle(table, update):
+    message = update.message
+    name = message.text[1:].split()[0]
+    clock.sqlite = 0
+
+    started = time.perf_counter()
+    table[name](message)
+    elapsed = time.perf_counter() - started
+
+    return name, elapsed, clock.sqlite
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run(args):
+    tb.commit_window = args.commit_window / 1000
+    tb.metrics_enabled = not args.no_metrics
+
+    table = handlers()
+    setup, stream = build_stream(args)
+
+    with scratch_database(args.db_dir):
+        for update in setup:
+            handle(table, update)
+
+        samples = defaultdict(list)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads or 1) as pool:
+            for name, elapsed, sqlite in pool.map(lambda update: handle(table, update), stream):
+                samples[name].append((elapsed, sqlite))
+        wall = time.perf_counter() - started
+
+    results = {}
+    for name, values in sorted(samples.items()):
+        latencies = [elapsed for elapsed, _ in values]
+        results[name] = {
+            'count'     : len(values),
+            'per_second': len(values) / sum(latencies) if sum(latencies) else 0,
+            'p50_ms'    : percentile(latencies, 50) * 1000,
+            'p95_ms'    : percentile(latencies, 95) * 1000,
+            'p99_ms'    : percentile(latencies, 99) * 1000,
+            'sqlite_ms' : statistics.mean(sqlite for _, sqlite in values) * 1000
+        }
+
+    return results, wall
+
+@contextlib.contextmanager
+def scratch_database(directory=None):
+    # A fresh database (in a temporary directory under directory) and no chats loaded from a previous one
+    tb.transmit = lambda item: None  # The stubbed transport: messages are rendered and queued, never sent
+    tb.owner_ids = {admin_id}  # As if started with BOT_OWNERS=0
+    tb.chats.clear()
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        tb.open_database(os.path.join(tmp, 'bench.db'))
+        try:
+            yield tmp
+        finally:
+            tb.close_database()
+            tb.chats.clear()
+
+def register(table, chat_id, users):
+    for user_id in [admin_id, *users]:
+        handle(table, make_update(chat_id, user_id, '/register'))
+
+def database_balances(chat_id):
+    return {row['telegram_id']: row['shares'] for row in
+            tb.read_query('SELECT telegram_id, shares FROM users WHERE chat_id = ?', (chat_id,))}
+
+def run_commit(args):
+    # The same write-heavy stream with each command committed on its own (a zero commit window), then group-committed
+    mix = write_mix if args.mix == default_mix else args.mix
+    rows = []
+    for window in (0, args.commit_window):
+        results, wall = run(argparse.Namespace(**dict(vars(args), mix=mix, commit_window=window,
+                                                      threads=args.threads or 32)))
+        latencies = [row for row in results.values()]
+        rows.append((window, wall, max(row['p99_ms'] for row in latencies)))
+
+    print(f"{'Commit window'.ljust(14)} | {'Seconds':>8} | {'Commands/s':>10} | {'Worst p99 ms':>12}")
+    print('=' * 55)
+    for window, wall, p99 in rows:
+        print(f"{f'{window:g} ms'.ljust(14)} | {wall:>8.2f} | {args.updates / wall:>10.1f} | {p99:>12.3f}")
+    print(f"\nGroup commit: {rows[0][1] / rows[1][1]:.2f}x the commands/s of committing each one. Every commit is "
+          f"an fsync, so what it buys depends on the disk under --db-dir.")
+
+def per_call(f, calls):
+    # Average seconds per call of f over calls calls
+    started = time.perf_counter()
+    for _ in range(calls):
+        f()
+
+    return (time.perf_counter() - started) / calls
+
+def run_lookup(args):
+    # The lookups every command makes (user by name, open bounty by name, a bounty reference, an old bounty by ID)
+    # as a chat's history grows from 100 to --history ended bounties. Ended bounties stay in the database, so the
+    # cost per lookup must stay flat.
+    table = handlers()
+    chat_id = -1000
+    sizes = [size for size in (100, 1000, 10000, 100000, 1000000) if size <= (args.history or 1000000)]
+    lookups = {
+        'user by name'     : lambda: tb.find_user_by_name(f'USER{args.users}'),
+        'bounty by name'   : lambda: tb.find_bounty_by_name('JOB0'),
+        'bounty reference' : lambda: tb.resolve_bounty('Job0'),
+        'old bounty by ID' : lambda: tb.get_bounty(1)
+    }
+    rows = []
+
+    with scratch_database(args.db_dir):
+        # The first bounty ends straight away, so it's ID 1 and historical from the start
+        handle(table, make_update(chat_id, admin_id, '/register'))
+        handle(table, make_update(chat_id, admin_id, '/addbounty old 1 10000'))
+        handle(table, make_update(chat_id, admin_id, '/endbounty old'))
+        register(table, chat_id, range(1, args.users + 1))
+        for i in range(args.bounties):
+            handle(table, make_update(chat_id, admin_id, f'/addbounty job{i} {args.users} 10000'))
+
+        created = 1
+        for size in sizes:
+            ended = [(f'old{i}', 1, tb.now() - 86400, tb.now() - 90000, chat_id) for i in range(created, size)]
+            tb.persist(('INSERT INTO bounties (name, worth, endtime, created_at, chat_id, is_active) '
+                        'VALUES (?, ?, ?, ?, ?, 0)', ended, tb.MANY))
+            created = size
+
+            tb.chats.clear()  # Loaded again, as after a restart
+            with tb.chat_scope(chat_id):
+                if missing := [name for name, lookup in lookups.items() if lookup() is None]:
+                    sys.exit("Nothing found for: " + ', '.join(missing))
+                rows.append((size, {name: per_call(lookup, args.calls or 100000) for name, lookup in lookups.items()}))
+
+    print(f"{'Bounties'.rjust(9)} | " + ' | '.join(f'{name:>16}' for name in lookups) + '   (ns per lookup)')
+    print('=' * (12 + 19 * len(lookups)))
+    for size, timings in rows:
+        print(f"{size:>9} | " + ' | '.join(f'{timings[name] * 1e9:>16.0f}' for name in lookups))
+
+    # Timer noise aside, the most history shouldn't cost more than a few times the least
+    grew = [name for name in lookups if rows[-1][1][name] > 3 * rows[0][1][name]]
+    if grew:
+        print("Lookups grew with history: " + ', '.join(grew))
+        sys.exit(1)
+
+def run_log(args):
+    # /showlog on a log of --rows rows (10M by default) spread over --users users and the last year: the first page,
+    # one further in and the last, each as fast as the indexes and keyset pagination allow
+    table = handlers()
+    chat_id = -1000
+    users = range(1, args.users + 1)
+    rng = random.Random(args.seed)
+
+    with scratch_database(args.db_dir):
+        register(table, chat_id, users)
+
+        started = time.perf_counter()
+        oldest = tb.now() - 365 * 86400
+        for first in range(0, args.rows, 100000):
+            rows = [(chat_id, rng.choice(users), rng.choice(users), 'bump', '', 1, oldest + i * 365 * 86400 // args.rows)
+                    for i in range(first, min(first + 100000, args.rows))]
+            tb.persist(('INSERT INTO log (chat_id, from_id, to_id, action, subject, amount, at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', rows, tb.MANY))
+        built = time.perf_counter() - started
+
+        entries = tb.read_query('SELECT COUNT(*) AS n FROM log WHERE chat_id = ? AND to_id = 1', (chat_id,))[0]['n']
+        last = max(1, -(-entries // tb.showlog_page_size))
+        pages = {'first page': 1, 'page 100': min(100, last), 'last page': last}
+        rows = []
+        for name, page in pages.items():
+            text = '/showlog @user1' + (f' page {page}' if page > 1 else '')
+            latencies = [handle(table, make_update(chat_id, admin_id, text))[1] for _ in range(args.calls or 20)]
+            rows.append((name, page, percentile(latencies, 50), percentile(latencies, 99)))
+
+    print(f"{args.rows} log rows written in {built:.1f}s; user1 has {entries} entries ({last} pages)\n")
+    print(f"{'/showlog'.ljust(10)} | {'Page':>6} | {'p50 ms':>8} | {'p99 ms':>8}")
+    print('=' * 42)
+    for name, page, p50, p99 in rows:
+        print(f"{name.ljust(10)} | {page:>6} | {p50 * 1000:>8.3f} | {p99 * 1000:>8.3f}")
+
+# Run in a fresh interpreter by run_startup(): argv is the database, a chat and one of its ended bounties
+startup_probe = """
+import json, sys, time
+
+def peak_rss():
+    # Kilobytes. Linux only; ru_maxrss would do elsewhere, but on Linux it carries over the parent's peak.
+    with open('/proc/self/status') as status:
+        return next(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+
+started = time.perf_counter()
+import thugs_bot as tb
+imported, imported_rss = time.perf_counter(), peak_rss()
+
+tb.open_database(sys.argv[1])
+opened = time.perf_counter()
+with tb.chat_scope(int(sys.argv[2])):
+    loaded = time.perf_counter()
+    tb.get_bounty(int(sys.argv[3]))
+    fetched = time.perf_counter()
+
+print(json.dumps({'import': imported - started, 'open': opened - imported, 'chat': loaded - opened,
+                  'old_bounty': fetched - loaded, 'imported_rss': imported_rss,
+                  'rss': peak_rss()}))
+tb.close_database()
+"""
+
+def run_startup(args):
+    # Startup time and peak RSS of a fresh bot process, on a chat with no history and one with --history ended
+    # bounties (500k by default) of three muscle each. Only what's live should be loaded, so they should match.
+    table = handlers()
+    chat_id = -1000
+    history = args.history or 500000
+    rows = []
+
+    for size in (0, history):
+        with scratch_database(args.db_dir) as tmp:
+            handle(table, make_update(chat_id, admin_id, '/register'))
+            handle(table, make_update(chat_id, admin_id, '/addbounty old 1 10000'))
+            handle(table, make_update(chat_id, admin_id, '/endbounty old'))
+            register(table, chat_id, range(1, args.users + 1))
+            for i in range(args.bounties):
+                handle(table, make_update(chat_id, admin_id, f'/addbounty job{i} {args.users} 10000'))
+
+            first = tb.read_query('SELECT MAX(bounty_id) AS id FROM bounties')[0]['id'] + 1
+            for start in range(0, size, 100000):
+                count = min(100000, size - start)
+                ended = [(f'old{i}', 3, tb.now() - 86400, tb.now() - 90000, chat_id) for i in range(start, start + count)]
+                muscle = [(first + i, (first + i + k) % args.users + 1) for i in range(start, start + count) for k in range(3)]
+                tb.persist(('INSERT INTO bounties (name, worth, endtime, created_at, chat_id, is_active) '
+                            'VALUES (?, ?, ?, ?, ?, 0)', ended, tb.MANY),
+                           ('INSERT INTO participation (bounty_id, telegram_id) VALUES (?, ?)', muscle, tb.MANY))
+
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (
+                os.path.dirname(os.path.abspath(tb.__file__)), os.environ.get('PYTHONPATH')))))
+            probe = subprocess.run([sys.executable, '-c', startup_probe, os.path.join(tmp, 'bench.db'), str(chat_id),
+                                    str(first if size else 1)], env=env, cwd=tmp, capture_output=True, text=True)
+            if probe.returncode:
+                sys.exit(probe.stdout + probe.stderr)
+            rows.append((size, json.loads(probe.stdout.splitlines()[-1])))
+
+    print(f"{'Ended bounties'.rjust(14)} | {'Import s':>8} | {'Open DB s':>9} | {'Load chat s':>11} | "
+          f"{'Old bounty ms':>13} | {'RSS MB':>7} | {'Import MB':>9}")
+    print('=' * 90)
+    for size, probe in rows:
+        print(f"{size:>14} | {probe['import']:>8.3f} | {probe['open']:>9.3f} | {probe['chat']:>11.3f} | "
+              f"{probe['old_bounty'] * 1000:>13.3f} | {probe['rss'] / 1024:>7.1f} | {probe['imported_rss'] / 1024:>9.1f}")
+
+def traced_bytes(build):
+    # Bytes newly allocated by build(), counting what it returns as long as it's alive
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+def run_records(args):
+    # Bytes per record for --size (100k by default) users and bounties held as the slotted records against the dicts
+    # (dict(row)) they used to be, and per bounty's muscle as a dict (for O(1) membership) against a list. The column
+    # values are read before measuring and shared by both, so only what holds them is counted.
+    chat_id = -1000
+    size = args.size or 100000
+
+    with scratch_database(args.db_dir):
+        tb.persist(('INSERT INTO users (chat_id, telegram_id, username, shares, created_at) VALUES (?, ?, ?, ?, ?)',
+                    [(chat_id, i, f'user{i}', 10, tb.now()) for i in range(1, size + 1)], tb.MANY),
+                   ('INSERT INTO bounties (name, worth, endtime, created_at, chat_id) VALUES (?, ?, ?, ?, ?)',
+                    [(f'job{i}', 3, tb.now() + 86400, tb.now(), chat_id) for i in range(size)], tb.MANY))
+        users = tb.read_query('SELECT * FROM users WHERE chat_id = ?', (chat_id,))
+        bounties = tb.read_query('SELECT * FROM bounties WHERE chat_id = ?', (chat_id,))
+        muscle = [(i, i + 1, i + 2) for i in range(size)]
+
+    rows = [
+        ('user', lambda: [dict(row) for row in users], lambda: [tb.User.from_row(row) for row in users]),
+        ('bounty', lambda: [dict(row) for row in bounties], lambda: [tb.Bounty.from_row(row) for row in bounties]),
+        ('3 muscle', lambda: [list(ids) for ids in muscle], lambda: [dict.fromkeys(ids) for ids in muscle])
+    ]
+
+    print(f"{'Bytes per'.ljust(9)} | {'Before':>7} | {'Now':>7} | {'Change':>7}   ({size} of each)")
+    print('=' * 51)
+    for name, before, after in rows:
+        old, new = traced_bytes(before) / size, traced_bytes(after) / size
+        print(f"{name.ljust(9)} | {old:>7.0f} | {new:>7.0f} | {new / old - 1:>+7.0%}")
+
+# Command texts as people type them, each with its handler's schema and how the handler used to split the text
+# again after num_arguments() had shlex-split it once
+parse_corpus = [
+    ('/bump @user7', (tb.MENTION,), str.split),
+    ('/bump@thugs_bot @user3', (tb.MENTION,), str.split),
+    ('/grant @user3 5', (tb.AMOUNTS,), str.split),
+    ('/cashout @user2 1 @user4 2 @user5 3', (tb.AMOUNTS,), str.split),
+    ('/onthejob 1', (tb.BOUNTY,), str.split),
+    ('/onthejob Big Job', (tb.BOUNTY,), str.split),
+    ('/abandon big', (tb.BOUNTY,), str.split),
+    ('/showlog @user1 page 2', (tb.MENTION, tb.REST), str.split),
+    ('/history @user1 30', (tb.MENTION, tb.REST), str.split),
+    ('/leaderboard top 10', (tb.REST,), str.split),
+    ('/role add dev @user2', (tb.TEXT, tb.TEXT, tb.MENTION), str.split),
+    ('/config set bump_shares 2', (tb.REST,), shlex.split),
+    ('/addbounty "Night Shift" 5 2d', (tb.TEXT, tb.NUMBER, tb.REST), shlex.split),
+    ('/addbounty \u201cCurly Quotes\u201d 3', (tb.TEXT, tb.NUMBER, tb.REST), shlex.split),
+    ('/endbounty "Big Job"', (tb.BOUNTY,), shlex.split)
+]
+
+def run_parse(args):
+    # Parsing each text in parse_corpus as the handlers used to (shlex, then their own split) against tokenize() and
+    # the whole of parse_arguments(), which also looks up the users and bounties named
+    table = handlers()
+    chat_id = -1000
+    calls = args.calls or 20000
+    rows = []
+
+    with scratch_database(args.db_dir):
+        register(table, chat_id, range(1, 11))
+        handle(table, make_update(chat_id, admin_id, '/addbounty "Big Job" 10'))
+
+        with tb.chat_scope(chat_id):
+            for text, schema, split in parse_corpus:
+                message = make_update(chat_id, admin_id, text).message
+                tb.parse_arguments(message, schema)  # Raises if the corpus and the handlers have drifted apart
+                before = per_call(lambda: (shlex.split(tb.fix_quotes(text)), split(tb.fix_quotes(text))), calls)
+                rows.append((text, before, per_call(lambda: tb.tokenize(message), calls),
+                             per_call(lambda: tb.parse_arguments(message, schema), calls)))
+
+    width = max(len(text) for text, *_ in rows)
+    print(f"{'Command'.ljust(width)} | {'Before':>7} | {'Tokenize':>8} | {'Parse':>7}   (us per command)")
+    print('=' * (width + 34))
+    for text, before, tokenized, parsed in rows:
+        print(f"{text.ljust(width)} | {before * 1e6:>7.2f} | {tokenized * 1e6:>8.2f} | {parsed * 1e6:>7.2f}")
+    print(f"{'Whole corpus'.ljust(width)} | " + ' | '.join(
+        f"{sum(row[i] for row in rows) * 1e6:>{w}.2f}" for i, w in ((1, 7), (2, 8), (3, 7))))
+
+def run_bulk(args):
+    # Paying out N users: N /grant commands, one /grant naming all N, and a /cashout CSV of N lines
+    table = handlers()
+    chat_id = -1000
+    size = args.size or 1000
+    users = range(1, size + 1)
+
+    with scratch_database():
+        register(table, chat_id, users)
+
+        started = time.perf_counter()
+        for user_id in users:
+            handle(table, make_update(chat_id, admin_id, f'/grant @user{user_id} 1'))
+        single = time.perf_counter() - started
+
+        text = '/grant ' + ' '.join(f'@user{user_id} 1' for user_id in users)
+        started = time.perf_counter()
+        handle(table, make_update(chat_id, admin_id, text))
+        bulk = time.perf_counter() - started
+
+        content = ''.join(f'user{user_id},2\n' for user_id in users).encode()
+        message = make_document(chat_id, '/cashout', content)
+        started = time.perf_counter()
+        tb.bulk_upload(message)
+        upload = time.perf_counter() - started
+
+    print(f"{'Payout'.ljust(22)} | {'Users':>6} | {'Seconds':>8} | {'Users/s':>9}")
+    print('=' * 54)
+    for name, elapsed in (('single /grant each', single), ('one bulk /grant', bulk), ('/cashout CSV upload', upload)):
+        print(f"{name.ljust(22)} | {size:>6} | {elapsed:>8.3f} | {size / elapsed:>9.1f}")
+
+def run_archive(args):
+    # Archive the whole log, keep bumping and reconcile: nothing written after the archive may go uncounted
+    table = handlers()
+    chat_id = -1000
+    users = range(1, args.users + 1)
+    tb.log_retention_days, tb.archive_pause = -1, 0  # Everything is old enough
+
+    with scratch_database():
+        register(table, chat_id, users)
+        for user_id in users:
+            handle(table, make_update(chat_id, user_id, f'/bump @user{user_id % args.users + 1}'))
+        tb.snapshot_balances()
+        tb.archive_log()
+        tb.archive_log()  # A second pass must find nothing left to take
+
+        remaining = tb.read_query('SELECT COUNT(*) AS n FROM log')[0]['n']
+        before = database_balances(chat_id)
+        for user_id in users:
+            handle(table, make_update(chat_id, user_id, f'/bump @user{user_id % args.users + 1}'))
+        tb.snapshot_balances()
+        handle(table, make_update(chat_id, admin_id, '/reconcile'))
+
+        with tb.chat_scope(chat_id):
+            drift = [(telegram_id, shares, expected) for telegram_id, shares, expected in tb.balance_drift(chat_id)
+                     if shares != expected]
+        after = database_balances(chat_id)
+        segments = tb.read_query('SELECT COUNT(*) AS n, COUNT(DISTINCT path) AS paths FROM log_segments')[0]
+
+    bumped = all(after[user_id] == before[user_id] + tb.Settings().bump_shares for user_id in users)
+    print(f"{remaining} live log row(s) left after archiving, {segments['n']} segment(s), drift {drift or 'none'}")
+    if remaining != 1 or drift or not bumped or segments['n'] != segments['paths']:
+        print("Archive check failed: " + ('bumps after archiving were lost' if not bumped else 'see above'))
+        sys.exit(1)
+    print("Archive check passed")
+
+def run_stress(args):
+    # Thousands of handler calls at once from --threads threads, cashouts racing bumps and grants for the same users.
+    # Afterwards memory, the users table and the log must agree on every balance, and nobody may be overdrawn.
+    table = handlers()
+    chats = [-1000 - i for i in range(args.chats)]
+    users = range(1, args.users + 1)
+    rng = random.Random(args.seed)
+    kinds = {'bump': 30, 'cashout': 25, 'grant': 10, 'onthejob': 15, 'abandon': 5, 'leaderboard': 10, 'showlog': 5}
+
+    calls = []
+    for kind in rng.choices(list(kinds), weights=list(kinds.values()), k=args.updates):
+        chat_id, user_id, target = rng.choice(chats), rng.choice(users), rng.choice(users)
+        if kind == 'bump':
+            calls.append(make_update(chat_id, user_id, f'/bump @user{target}'))
+        elif kind in ('grant', 'cashout'):
+            # Cashouts ask for more than most users have, so plenty get turned down
+            calls.append(make_update(chat_id, admin_id, f'/{kind} @user{target} {rng.randint(1, 15)}'))
+        elif kind in ('onthejob', 'abandon'):
+            calls.append(make_update(chat_id, user_id, f'/{kind} job{rng.randrange(args.bounties)}'))
+        else:
+            calls.append(make_update(chat_id, user_id, f'/{kind}'))
+
+    with scratch_database():
+        for chat_id in chats:
+            register(table, chat_id, users)
+            for i in range(args.bounties):
+                handle(table, make_update(chat_id, admin_id, f'/addbounty job{i} {args.users} 10000'))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads or 32) as pool:
+            list(pool.map(lambda update: handle(table, update), calls))
+        wall = time.perf_counter() - started
+
+        mismatched, drift, overdrawn = [], [], []
+        for chat_id in chats:
+            stored = database_balances(chat_id)
+            with tb.chat_scope(chat_id):
+                memory = {user.telegram_id: user.shares for user in tb.runtime()['users'].values()}
+                drift += [(chat_id, telegram_id, shares, expected)
+                          for telegram_id, shares, expected in tb.balance_drift(chat_id) if shares != expected]
+            mismatched += [(chat_id, telegram_id) for telegram_id in stored.keys() | memory.keys()
+                           if stored.get(telegram_id) != memory.get(telegram_id)]
+            overdrawn += [(chat_id, telegram_id) for telegram_id, shares in stored.items() if shares < 0]
+        cashouts = tb.read_query("SELECT COUNT(*) AS n FROM log WHERE action = '$out'")[0]['n']
+
+    print(f"{len(calls)} handler calls on {args.threads or 32} threads in {wall:.2f}s ({len(calls) / wall:.1f}/s), "
+          f"{cashouts} cashouts went through")
+    print(f"memory vs database {len(mismatched)} off, database vs log {len(drift)} off, {len(overdrawn)} overdrawn")
+    if mismatched or drift or overdrawn:
+        print("Stress check failed: " + ', '.join(map(str, (mismatched + drift + overdrawn)[:10])))
+        sys.exit(1)
+    print("Stress check passed")
+
+class TelegramServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 256
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A bot being stopped drops its connections mid-request; not worth a traceback
+        pass
+
+class FakeTelegram(http.server.BaseHTTPRequestHandler):
+    # Answers Bot API calls the way Telegram would, after a delay, and counts them by method. getUpdates hands out
+    # whatever is in updates; the times an update went out and its reply came back are kept by message_id.
+    # Sends can be turned down too: the first one to each chat with a 429 when retry_after is set, and every one to
+    # a chat in refused with a 400.
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+    retry_after = 0
+    refused = set()
+    calls = defaultdict(int)
+    lock = threading.Lock()
+    arrived = threading.Condition(lock)
+    updates = []  # Consecutive update_ids
+    delivered = {}
+    answered = {}
+    sends = defaultdict(list)  # chat_id -> (clock, status, text) for every send, turned down or not
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urllib.parse.urlsplit(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        # Parameters come in the query string (sync) or as a form (async)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update(urllib.parse.parse_qsl(body.decode()))
+        with self.lock:
+            self.calls[method] += 1
+
+        status = 200
+        if method == 'getUpdates':
+            answer = {'ok': True, 'result': self.get_updates(int(params.get('offset', 0)),
+                                                             float(params.get('timeout', 0)))}
+        elif method == 'getMe':
+            time.sleep(self.delay)
+            answer = {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}}
+        else:
+            time.sleep(self.delay)
+            chat_id = int(params.get('chat_id', 0))
+            answer = {'ok': True, 'result': {'message_id': 1, 'date': int(time.time()), 'text': '',
+                                             'chat': {'id': chat_id, 'type': 'supergroup'}}}
+            with self.lock:
+                if chat_id in self.refused:
+                    status, answer = 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}
+                elif self.retry_after and not self.sends[chat_id]:
+                    status, answer = 429, {'ok': False, 'error_code': 429,
+                                           'description': f"Too Many Requests: retry after {self.retry_after}",
+                                           'parameters': {'retry_after': self.retry_after}}
+                clock = time.perf_counter()
+                self.sends[chat_id].append((clock, status, params.get('text', '')))
+                reply = params.get('reply_to_message_id') or json.loads(params.get('reply_parameters', '{}')).get(
+                    'message_id')
+                if reply and status == 200:
+                    self.answered.setdefault(int(reply), clock)
+
+        answer = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def get_updates(self, offset, timeout):
+        with self.arrived:
+            start = max(0, offset - self.updates[0]['update_id']) if self.updates else 0
+            # Long polling, cut short so a bot being stopped isn't kept waiting
+            self.arrived.wait_for(lambda: len(self.updates) > start, timeout=min(timeout, 1))
+            updates = self.updates[start:start + 100]
+            clock = time.perf_counter()
+            for update in updates:
+                self.delivered.setdefault(update['message']['message_id'], clock)
+
+        return updates
+
+    def log_message(self, format, *args):
+        pass
+
+@contextlib.contextmanager
+def fake_telegram(delay=0, retry_after=0, refused=()):
+    # Yields the API_URL template that points telebot at a local FakeTelegram
+    FakeTelegram.delay, FakeTelegram.retry_after, FakeTelegram.refused = delay, retry_after, set(refused)
+    for log in (FakeTelegram.calls, FakeTelegram.updates, FakeTelegram.delivered, FakeTelegram.answered,
+                FakeTelegram.sends):
+        log.clear()
+    server = TelegramServer(('127.0.0.1', 0), FakeTelegram)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class FakeRedis(socketserver.StreamRequestHandler):
+    # Just enough of a Redis server for RedisUpdateLog: SET with NX and EX, after the HELLO redis-py opens with.
+    # Anything else gets an error, which redis-py shrugs off for the CLIENT SETINFO it also sends.
+    expires = {}  # key -> when it expires
+    sets = 0
+    lock = threading.Lock()
+
+    def handle(self):
+        null = b'$-1\r\n'
+        while line := self.rfile.readline():
+            args = [self.rfile.read(int(self.rfile.readline()[1:]) + 2)[:-2] for _ in range(int(line[1:]))]
+            command = args[0].upper()
+            if command == b'HELLO':
+                # RESP3 if asked for; it only changes how "not set" comes back
+                null = b'_\r\n' if args[1:] == [b'3'] else null
+                answer = b'%1\r\n+proto\r\n:' + (args[1] if len(args) > 1 else b'2') + b'\r\n'
+            elif command == b'SET':
+                options = [arg.upper() for arg in args[3:]]
+                ttl = int(args[3 + options.index(b'EX') + 1]) if b'EX' in options else None
+                with self.lock:
+                    FakeRedis.sets += 1
+                    clock = time.monotonic()
+                    if b'NX' in options and self.expires.get(args[1], clock) > clock:
+                        answer = null
+                    else:
+                        self.expires[args[1]] = clock + ttl if ttl else float('inf')
+                        answer = b'+OK\r\n'
+            else:
+                answer = b'-ERR unknown command\r\n'
+            self.wfile.write(answer)
+
+@contextlib.contextmanager
+def fake_redis():
+    # Yields the redis:// URL of a local FakeRedis
+    FakeRedis.expires.clear()
+    FakeRedis.sets = 0
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeRedis)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"redis://127.0.0.1:{server.server_address[1]}/0"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@contextlib.contextmanager
+def bot_process(tmp, **env):
+    # thugs_bot.py run as the bot, with its database, logs and console output (console.log) in tmp. Unless env says
+    # otherwise, outgoing messages aren't paced, so the fake Telegram sees them as soon as the bot lets them go.
+    console = open(os.path.join(tmp, 'console.log'), 'w')
+    env = {**os.environ, 'DB_PATH': os.path.join(tmp, 'bench.db'), 'LOG_PATH': os.path.join(tmp, 'bench.log'),
+           'GROUP_MESSAGES_PER_MIN': '1e9', 'CHAT_MESSAGES_PER_SEC': '1e9', 'CHAT_BURST': '1000000', **env}
+    bot = subprocess.Popen([sys.executable, os.path.abspath(tb.__file__)], env=env, cwd=tmp, stdout=console,
+                           stderr=subprocess.STDOUT)
+    try:
+        yield bot
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(60)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        console.close()
+
+def post(port, body):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('POST', '/', body, {'Content-Type': 'application/json'})
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+def free_port():
+    with contextlib.closing(socket.socket()) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def listening(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+def wait_until(check, timeout):
+    deadline = time.monotonic() + timeout
+    while not (done := check()) and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+    return done
+
+def run_webhook(args):
+    # Replays updates into `thugs_bot.py` in webhook mode with --workers processes: every update is POSTed twice in
+    # a row and the whole stream once more at the end, the way Telegram redelivers what it thinks went unanswered.
+    # Each update must still be applied and answered exactly once, and malformed bodies turned away with a 400.
+    # With --update-log redis the workers remember updates in a stand-in Redis (through redis-py, so that has to be
+    # installed) instead of the database.
+    chats = [-1000 - i for i in range(args.chats)]
+    rng = random.Random(args.seed)
+    streams, received = {}, defaultdict(int)
+    for chat_id in chats:
+        stream = [update_json(chat_id, user_id, '/register') for user_id in range(1, args.users + 1)]
+        for _ in range(args.bumps):
+            sender = rng.randint(1, args.users)
+            target = sender % args.users + 1
+            received[chat_id, target] += 1
+            stream.append(update_json(chat_id, sender, f'/bump @user{target}'))
+        streams[chat_id] = [json.dumps(update) for update in stream]
+    total = sum(map(len, streams.values()))
+    malformed = ['[]', '"message"', '{"message": []}', '{"message": {"chat": {"id": "-1000"}}}', 'not json']
+
+    with tempfile.TemporaryDirectory() as tmp, fake_telegram() as api_url, contextlib.ExitStack() as stack:
+        port = free_port()
+        db = os.path.join(tmp, 'bench.db')
+        update_log = stack.enter_context(fake_redis()) if args.update_log == 'redis' else 'sqlite'
+        with bot_process(tmp, BOT_MODE='webhook', WEBHOOK_PORT=str(port), WEBHOOK_WORKERS=str(args.workers),
+                         TELEGRAM_API_URL=api_url, UPDATE_LOG=update_log):
+            if not wait_until(lambda: listening(port), 30):
+                sys.exit("Webhook server didn't come up")
+
+            def replay(chat_id):
+                statuses = [post(port, body) for body in streams[chat_id] for _ in range(2)]
+                return statuses + [post(port, body) for body in streams[chat_id]]
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=min(len(chats), 16)) as pool:
+                statuses = [status for chat in pool.map(replay, chats) for status in chat]
+            rejected = [post(port, body) for body in malformed]
+
+            def count(query):
+                with contextlib.closing(sqlite3.connect(db, timeout=30)) as connection:
+                    return connection.execute(query).fetchone()[0]
+
+            applied = lambda: count("SELECT COUNT(*) FROM log WHERE action IN ('reg', 'bump')")
+            wait_until(lambda: applied() >= total, 120)
+            answered = lambda: FakeTelegram.calls['sendMessage'] >= total
+            wait_until(answered, 60)
+            wall = time.perf_counter() - started
+            time.sleep(1)  # Long enough for a duplicate to show up, if one got through
+
+            with contextlib.closing(sqlite3.connect(db, timeout=30)) as connection:
+                balances = {(row[0], row[1]): row[2] for row in
+                            connection.execute('SELECT chat_id, telegram_id, shares FROM users')}
+                logged, in_database = applied(), count('SELECT COUNT(*) FROM updates')
+            remembered = len(FakeRedis.expires) if args.update_log == 'redis' else in_database
+
+        with open(os.path.join(tmp, 'console.log')) as console:
+            output = console.read()
+
+    settings = tb.Settings()
+    wrong = [(chat_id, user_id) for chat_id in chats for user_id in range(1, args.users + 1)
+             if balances.get((chat_id, user_id)) != settings.initial_shares +
+             received[chat_id, user_id] * settings.bump_shares]
+    sent = FakeTelegram.calls['sendMessage']
+
+    print(f"{len(statuses)} POSTs of {total} updates to {args.workers} worker(s) in {wall:.2f}s "
+          f"({len(statuses) / wall:.1f}/s), remembered in {args.update_log}")
+    print(f"applied {logged}, remembered {remembered}, answered {sent}, wrong balances {len(wrong)}, "
+          f"malformed answered {sorted(set(rejected))}")
+    # With Redis as the update log, nothing may have gone to the database's instead
+    stray = in_database if args.update_log == 'redis' else 0
+    if set(statuses) != {200} or set(rejected) != {400} or logged != total or remembered != total or \
+            sent != total or wrong or stray:
+        print("Webhook replay check failed; the bot's output ends with:\n" + output[-4000:])
+        sys.exit(1)
+    print("Webhook replay check passed")
+
+def run_transport(args):
+    # The bot as it really runs in each BOT_MODE, polling a local fake Telegram that answers after --delay ms.
+    # Updates arrive at --rate a second, each a new user's /register or a /bountylist, and both answer with a reply.
+    # Latency runs from getUpdates handing an update out to the reply to it reaching Telegram. A chat's replies go
+    # out one at a time, so with few --chats the outbox rather than the mode sets the pace.
+    chats = [-1000 - i for i in range(args.chats)]
+    rows = []
+
+    for mode in ('sync', 'async'):
+        updates = [update_json(chats[i % len(chats)], i + 1, '/register' if i % 4 else '/bountylist')
+                   for i in range(args.updates)]
+
+        with tempfile.TemporaryDirectory(dir=args.db_dir) as tmp, fake_telegram(args.delay / 1000) as api_url:
+            with bot_process(tmp, BOT_MODE=mode, TELEGRAM_API_URL=api_url):
+                started = time.perf_counter()
+                for i, update in enumerate(updates):
+                    # Sleep to the update's arrival time, so a slow bot falls behind instead of slowing the stream
+                    time.sleep(max(0, started + i / args.rate - time.perf_counter()))
+                    with FakeTelegram.arrived:
+                        FakeTelegram.updates.append(update)
+                        FakeTelegram.arrived.notify_all()
+                wait_until(lambda: len(FakeTelegram.answered) >= len(updates), 60)
+
+            with FakeTelegram.lock:
+                latencies = [FakeTelegram.answered[key] - delivered for key, delivered in FakeTelegram.delivered.items()
+                             if key in FakeTelegram.answered]
+            if not latencies:
+                with open(os.path.join(tmp, 'console.log')) as console:
+                    sys.exit(f"No replies in {mode} mode; the bot's output ends with:\n" + console.read()[-4000:])
+
+        rows.append((mode, len(latencies), percentile(latencies, 50), percentile(latencies, 99)))
+
+    print(f"{'Mode'.ljust(6)} | {'Answered':>8} | {'p50 ms':>8} | {'p99 ms':>8}   ({args.updates} updates at "
+          f"{args.rate:g}/s, Telegram answering in {args.delay:g} ms)")
+    print('=' * 42)
+    for mode, answered, p50, p99 in rows:
+        print(f"{mode.ljust(6)} | {answered:>8} | {p50 * 1000:>8.2f} | {p99 * 1000:>8.2f}")
+
+def run_pacing(args):
+    # The bot in each BOT_MODE against a fake Telegram that turns the first send to every chat down with a 429 and
+    # refuses every send to one more chat with a 400. In each of --chats groups (plus the refused one) --size users
+    # /register, then all take on one bounty. A 429'd chat must stay quiet for the retry_after it was given, no chat
+    # may get more than the rate and burst allow, the /onthejob thanks must go out coalesced without losing a name,
+    # and a 400 is never retried.
+    chats = [-1000 - i for i in range(args.chats)]
+    refused = -999
+    users = range(1, (args.size or 20) + 1)
+    rate, burst, retry_after, window = 10, 3, 2, 1
+    failed = []
+
+    print(f"{'Mode'.ljust(6)} | {'Sends':>6} | {'429s':>5} | {'400s':>5} | {'Thanks':>6} | {'Wall s':>6}   "
+          f"({len(chats)} chats of {len(users)} users at {rate}/s, burst {burst}, retry_after {retry_after}s, "
+          f"coalescing for {window}s)")
+    print('=' * 50)
+    for mode in ('sync', 'async'):
+        setup = [update_json(chat_id, user_id, '/register') for chat_id in chats for user_id in users]
+        setup += [update_json(chat_id, admin_id, f'/addbounty job {len(users)} 10000') for chat_id in chats]
+        turned_away = [update_json(refused, user_id, '/register') for user_id in users]
+        onthejob = [update_json(chat_id, user_id, '/onthejob job') for chat_id in chats for user_id in users]
+
+        def push(updates):
+            with FakeTelegram.arrived:
+                FakeTelegram.updates.extend(updates)
+                FakeTelegram.arrived.notify_all()
+
+        def sends(chat_id, status=None):
+            with FakeTelegram.lock:
+                return [send for send in FakeTelegram.sends[chat_id] if status is None or send[1] == status]
+
+        def thanked(chat_id):
+            return {int(name) for _, _, text in sends(chat_id, 200) if text.startswith('Thanks for taking on')
+                    for name in re.findall(r'user(\d+)', text)}
+
+        with tempfile.TemporaryDirectory(dir=args.db_dir) as tmp, \
+                fake_telegram(retry_after=retry_after, refused=[refused]) as api_url:
+            with bot_process(tmp, BOT_MODE=mode, TELEGRAM_API_URL=api_url, BOT_OWNERS=str(admin_id),
+                             GROUP_MESSAGES_PER_MIN=str(rate * 60), CHAT_BURST=str(burst),
+                             COALESCE_WINDOW_SEC=str(window)):
+                started = time.perf_counter()
+                push(setup + turned_away)
+                # Everyone is registered and the bounty is up before anyone takes it on
+                wait_until(lambda: all(len(sends(chat_id, 200)) > len(users) for chat_id in chats), 60)
+                push(onthejob)
+                wait_until(lambda: all(thanked(chat_id) >= set(users) for chat_id in chats) and
+                           len(sends(refused)) >= len(users), 60)
+                wall = time.perf_counter() - started
+                time.sleep(retry_after + 1)  # Long enough for a retried 400 to show up
+
+            with open(os.path.join(tmp, 'console.log')) as console:
+                output = console.read()
+
+        rows = {chat_id: sends(chat_id) for chat_id in chats}
+        thanks = sum(1 for chat_id in chats for _, status, text in rows[chat_id]
+                     if status == 200 and text.startswith('Thanks for taking on'))
+        print(f"{mode.ljust(6)} | {sum(map(len, rows.values())):>6} | "
+              f"{sum(1 for row in rows.values() for send in row if send[1] == 429):>5} | {len(sends(refused)):>5} | "
+              f"{thanks:>6} | {wall:>6.2f}")
+
+        for chat_id, row in rows.items():
+            times = [clock for clock, _, _ in row]
+            blocked = [clock + retry_after for clock, status, _ in row if status == 429]
+            if not blocked or any(later < blocked[0] for later in times[1:]):
+                failed.append(f"{mode}: chat {chat_id} sent again before its retry_after was up")
+            # Every stretch of sends fits in the burst plus what the rate refills over it (a little slack for the
+            # time a send takes to get here)
+            if any(j - i + 1 > burst + rate * (times[j] - times[i] + 0.05)
+                   for i in range(len(times)) for j in range(i + 1, len(times))):
+                failed.append(f"{mode}: chat {chat_id} was sent to faster than {rate}/s with a burst of {burst}")
+            if thanked(chat_id) != set(users):
+                failed.append(f"{mode}: chat {chat_id} thanked {len(thanked(chat_id))} of {len(users)} users")
+        if thanks >= len(onthejob):
+            failed.append(f"{mode}: {thanks} thanks for {len(onthejob)} /onthejob, nothing was coalesced")
+        if len(sends(refused)) != len(users):
+            failed.append(f"{mode}: {len(sends(refused))} sends to the refused chat for {len(users)} replies")
+        if failed:
+            print("Pacing check failed: " + '; '.join(failed[:10]) + "\nThe bot's output ends with:\n" + output[-4000:])
+            sys.exit(1)
+
+    print("Pacing check passed")
+
+def report(results, wall, updates):
+    print(f"{'Command'.ljust(12)} | {'Count':>6} | {'Ops/s':>9} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | "
+          f"{'SQLite ms':>9}")
+    print('=' * 80)
+    for name, row in results.items():
+        print(f"{name.ljust(12)} | {row['count']:>6} | {row['per_second']:>9.1f} | {row['p50_ms']:>8.3f} | "
+              f"{row['p95_ms']:>8.3f} | {row['p99_ms']:>8.3f} | {row['sqlite_ms']:>9.3f}")
+    print(f"\n{updates} updates in {wall:.2f}s ({updates / wall:.1f}/s)")
+
+def regressions(results, baseline, tolerance):
+    # A command regresses if its p95 grew, or its throughput fell, by more than tolerance
+    found = []
+    for name, row in results.items():
+        if (before := baseline.get(name)) is None:
+            continue
+
+        if row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            found.append(f"{name}: p95 {before['p95_ms']:.3f}ms -> {row['p95_ms']:.3f}ms")
+        if row['per_second'] < before['per_second'] * (1 - tolerance):
+            found.append(f"{name}: {before['per_second']:.1f}/s -> {row['per_second']:.1f}/s")
+
+    return found
+
+def run_mix(args):
+    results, wall = run(args)
+    report(results, wall, args.updates)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        return print(f"Baseline saved to {args.baseline}")
+
+    if not os.path.exists(args.baseline):
+        return
+
+    with open(args.baseline) as f:
+        found = regressions(results, json.load(f), args.tolerance)
+
+    if found:
+        print('\nRegressions against ' + args.baseline + ':\n  ' + '\n  '.join(found))
+        sys.exit(1)
+
+modes = {
+    'mix'    : run_mix,
+    'commit' : run_commit,
+    'lookup' : run_lookup,
+    'log'    : run_log,
+    'startup': run_startup,
+    'records': run_records,
+    'parse'  : run_parse,
+    'bulk'   : run_bulk,
+    'archive': run_archive,
+    'stress' : run_stress,
+    'webhook'  : run_webhook,
+    'transport': run_transport,
+    'pacing'   : run_pacing
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay synthetic updates through the bot and time each command')
+    parser.add_argument('mode', nargs='?', default='mix', choices=modes)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--bounties', type=int, default=10)
+    parser.add_argument('--chats', type=int, default=1)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--mix', default=default_mix, help=f'command=weight pairs (default {default_mix})')
+    parser.add_argument('--threads', type=int, help='updates handled concurrently (default 1, stress 32)')
+    parser.add_argument('--commit-window', type=float, default=tb.commit_window * 1000, help='ms, see DB_COMMIT_WINDOW_MS')
+    parser.add_argument('--db-dir', help='where the scratch database goes (default: the system temp directory)')
+    parser.add_argument('--no-metrics', action='store_true', help='run without instrumentation, to see what it costs')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--size', type=int, help='bulk: users paid out at once (default 1000); records: records of '
+                                                 'each kind (default 100000); pacing: users in each chat (default 20)')
+    parser.add_argument('--rows', type=int, default=10000000, help='log: rows in the synthetic log')
+    parser.add_argument('--history', type=int, help='lookup, startup: ended bounties (default 1000000, 500000)')
+    parser.add_argument('--calls', type=int, help='lookup, log, parse: calls timed for each measurement '
+                                                  '(default 100000, 20, 20000)')
+    parser.add_argument('--delay', type=float, default=20, help='transport: ms the fake Telegram takes to answer')
+    parser.add_argument('--rate', type=float, default=100, help='transport: updates arriving per second')
+    parser.add_argument('--workers', type=int, default=3, help='webhook: worker processes')
+    parser.add_argument('--bumps', type=int, default=200, help='webhook: /bump updates per chat')
+    parser.add_argument('--update-log', choices=('sqlite', 'redis'), default='sqlite',
+                        help='webhook: where workers remember handled updates (redis: a local stand-in server)')
+    args = parser.parse_args()
+
+    tb.persist = timed_sqlite(tb.persist)
+    tb.read_query = timed_sqlite(tb.read_query)
+    modes[args.mode](args)
+
+if __name__ == '__main__':
+    main()
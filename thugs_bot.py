@@ -1,11 +1,36 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import csv
 import datetime
+import gzip
+import heapq
+import io
+import http.server
+import itertools
 import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import pathlib
+import queue
+import re
 import shlex
 import sqlite3
+import sys
 import telebot
-from collections import defaultdict
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
 from dotenv import load_dotenv
+from typing import NewType
+from telebot.apihelper import ApiTelegramException
 from urllib.request import urlopen, Request
 
 load_dotenv()
@@ -13,19 +38,97 @@ load_dotenv()
 if (API_TOKEN := os.getenv('API_KEY_TG')) is None:
     raise EnvironmentError('No API Key defined!')
 
-fallback = {
-    'allocation'    : '$100',
-    'initial_shares': 10,
-    'bump_shares'   : 1,
-    'otj_shares'    : 1
-}
+Money = NewType('Money', str)  # An amount with an optional currency symbol or unit, e.g. $100 or 250 USDC
+Duration = NewType('Duration', int)  # Seconds; set as 90 (minutes), 45m, 12h, 3d or 1w
+
+@dataclass(slots=True)
+class User:
+    telegram_id: int
+    username: str
+    shares: int
+    created_at: int
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row):
+        return cls(**{field.name: row[field.name] for field in fields(cls)})
+
+@dataclass(slots=True)
+class Bounty:
+    bounty_id: int
+    name: str
+    worth: int
+    endtime: int
+    created_at: int
+    is_active: bool = True
+    chat_id: int = None
+    pool: int = 0  # Shares split among the muscle when it ends; 0 for bounties that don't settle
+    settlement: str = None  # None, 'pending' once ended with a pool, 'paid' once the pool went out
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row):
+        return cls(**{field.name: row[field.name] for field in fields(cls)})
+
+@dataclass(slots=True)
+class Settings:
+    # The schema for /config: each field's type says how its value is checked and shown
+    allocation: Money = '$100'
+    initial_shares: int = 10
+    bump_shares: int = 1
+    otj_shares: int = 1
+    bounty_duration: Duration = 86400  # For /addbounty without a time limit
+    bounty_pool: int = 0  # Shares new bounties split among their muscle when they end; 0 turns settlement off
+
+def new_runtime(chat_id):
+    return {
+        'chat_id'        : chat_id,
+        'in_use'         : 0,   # Handlers currently working in this chat; it isn't evicted while they are
+        'stale'          : False,  # Reload from the database once nobody is using it
+        'users'          : {},
+        'usernames'      : {},  # name_key(username) -> user
+        'bounties'       : {},  # Open bounties; ended ones are read on demand into bounty_history
+        'active_bounties': {},  # name_key(name) -> bounty, open bounties only
+        'bounty_names'   : [],  # Sorted keys of active_bounties, for prefix matches
+        'bounty_refs'    : {},  # resolve_bounty() results by name_key(ref); cleared when active bounties change
+        'participation'  : defaultdict(dict),  # bounty_id -> {telegram_id: None}; an insertion-ordered set
+        'bounty_history' : OrderedDict(),  # bounty_id -> (bounty, participation), least recently used first
+        'settings'       : Settings(),
+        'roles'          : defaultdict(set),  # role -> {telegram_id}
+        'log_versions'   : defaultdict(int),  # telegram_id (None for the whole chat) -> balance changes seen
+        'history'        : OrderedDict(),  # rendered /history and /trend by (telegram_id, days, today, version)
+        'leaderboard'    : {
+            'ranking': [],  # (-shares, telegram_id), kept sorted as shares change
+            'total'  : 0,
+            'cache'  : {}   # rendered messages, dropped whenever the board changes
+        }
+    }
 
-runtime = {
-    'users'        : defaultdict(dict),
-    'bounties'     : defaultdict(dict),
-    'participation': defaultdict(list), # List
-    'settings'     : fallback
-}
+# Every group gets its own users, bounties, settings and leaderboard. A chat's state is loaded when something
+# happens in it and dropped again once enough other chats have been used more recently.
+chats = OrderedDict()  # chat_id -> new_runtime(chat_id), least recently used first
+chats_lock = threading.Lock()
+chats_loading = {}  # chat_id -> Event set once the chat being loaded is in chats (or its load failed)
+max_open_chats = int(os.getenv('MAX_OPEN_CHATS', 64))
+current_chat = contextvars.ContextVar('current_chat')
+
+def runtime():
+    # State of the chat the current handler (or expiring bounty) belongs to
+    return current_chat.get()
+
+def owns_chat(chat_id):
+    # Only one worker process may keep (and expire bounties for) a given chat
+    return worker_count == 1 or (chat_id or 0) % worker_count == worker_index
+
+bounty_history_size = 256
+bounty_refs_size = 1024
+leaderboard_page_size = 25
+showlog_page_size = 15
+# CSV payouts for /grant and /cashout
+bulk_max_bytes = 512 * 1024
+bulk_max_rows = 5000
+bulk_summary_rows = 25  # Users listed in the reply; Telegram messages top out at 4096 characters
+history_default_days = 30
+history_max_days = 365
+history_cache_size = 32  # Rendered charts kept per chat
 
 strings = {
     'general_error'     : "I had an issue processing this request. I've logged the error.",
@@ -37,12 +140,145 @@ strings = {
     'not_participating' : "Did you bump your head? You're not even part of this bounty!",
     'bounty_full'       : "Sorry, we have all the muscle we need for this job.",
     'bounty_value_error': "Could not add the bounty: Share value must be a positive number!",
-    'bounty_limit_error': "Could not add the bounty: Provide a positive number of minutes!"
+    'bounty_limit_error': "Could not add the bounty: Give the time limit in minutes, or like `12h` or `3d`!"
 }
 
+db_path = os.getenv('DB_PATH', 'thugsDB.db')
+# The group a database from before per-chat state belongs to, if its bounties don't already say
+primary_chat_id = os.getenv('PRIMARY_CHAT_ID')
+# How long the writer waits for more commands to share a single commit with
+commit_window = float(os.getenv('DB_COMMIT_WINDOW_MS', 5)) / 1000
+commit_batch_size = 256
+read_pool_size = int(os.getenv('DB_READERS', 4))
+migration_chunk_size = 5000
+MANY = 'many'  # Third item of a persist() statement whose params are a list of rows, for executemany
+write_queue = queue.Queue()
+read_pool = queue.Queue()
+writer = None
+
+# The log is the record of every share change; users.shares is kept in step with it in the same transaction, and
+# balance_snapshots hold each balance as of a log rowid, so checking or rebuilding one only replays the log after it
+snapshot_interval = float(os.getenv('BALANCE_SNAPSHOT_SEC', 3600))
+snapshot_chunk_size = 5000  # Log rows folded into the snapshots per transaction
+reconcile_chunk_size = 500  # Users checked per query by /reconcile
+maintenance = None
+maintenance_stop = threading.Event()
+
+# Log rows older than this, once they're in the snapshots, move to gzipped JSONL segments and per-day totals
+log_retention_days = float(os.getenv('LOG_RETENTION_DAYS', 90))
+archive_dir = os.getenv('ARCHIVE_DIR')  # Defaults to log-archive/ next to the database
+archive_root = None
+archive_batch_size = 5000  # Rows per segment, moved in one transaction
+archive_pause = 0.5  # Seconds between batches, so a big backlog doesn't crowd out commands
+
+expiry_heap = []  # (endtime, chat_id, bounty_id); entries for bounties that ended early are skipped when popped
+expiry_cv = threading.Condition()
+scheduler = None
+expiry_since = 0  # bounties that ran out before this (i.e. while the bot was down) are closed without a post
+
+# Guards in-memory state that handlers check-then-modify (share balances, bounty participation)
+state_lock = threading.RLock()
+
+# Roles live in the roles table; the usernames below only seeded it for users already registered when migration 9
+# ran. Anyone can pick a display name, so nothing is granted by name any more: owners (BOT_OWNERS) are admin and dev
+# in every chat, private ones included, and grant the rest with /role.
 admin_usernames = ['Hammerloaf', 'mikeythug1', 'SensoryYard', '@DefiDebauchery']
 dev_usernames = ['SensoryYard', '@DefiDebauchery']
+owner_ids = {int(owner) for owner in os.getenv('BOT_OWNERS', '').split(',') if owner.strip()}  # Telegram user IDs
+roles = ('admin', 'dev')  # admin runs the admin commands; dev also gets DMs about the chat's errors
+# Optionally, a group's Telegram administrators count as admins too, looked up at most once per TTL per chat
+chat_admin_sync = os.getenv('CHAT_ADMIN_SYNC', '0') == '1'
+chat_admin_ttl = float(os.getenv('CHAT_ADMIN_TTL_SEC', 300))
+chat_admins = {}  # chat_id -> (expires at, {telegram_id})
+
+# JSON lines, written and rotated off the request path by a queue listener
+log_path = os.getenv('LOG_PATH', 'thugs_bot.log')
+log_max_bytes = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+log_backups = int(os.getenv('LOG_BACKUPS', 5))
+# Errors DM the devs; repeats of the same error within the window are summed up in one message at its end
+alert_window = float(os.getenv('ALERT_WINDOW_SEC', 300))
+alert_limit = 5  # Immediate DMs per window across all errors; anything past that only shows up in summaries
+logger = logging.getLogger('thugs_bot')
+log_listener = None
+alerts = None
+dev_recipients = {}  # chat_id -> its devs, for alerts; looked up on a chat's first error and kept current by /role
+# 'sync' runs handlers on telebot's polling thread pool; 'async' runs them off an AsyncTeleBot event loop;
+# 'webhook' takes updates over HTTP and hands them to worker processes
+bot_mode = os.getenv('BOT_MODE', 'sync')
+handler_threads = int(os.getenv('HANDLER_THREADS', 8))
+
+# Webhook mode. TLS is left to the reverse proxy in front; Telegram only delivers to HTTPS. All workers run on one
+# host: they share the SQLite file, and each chat's state lives in its worker's memory. Running the bot on more than
+# one host is not supported.
+webhook_url = os.getenv('WEBHOOK_URL')  # Registered with Telegram at startup when set
+webhook_listen = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+webhook_port = int(os.getenv('WEBHOOK_PORT', 8080))
+webhook_secret = os.getenv('WEBHOOK_SECRET')  # Checked against X-Telegram-Bot-Api-Secret-Token
+# Every chat belongs to exactly one worker (chat_id % webhook_workers), so its in-memory state stays authoritative
+webhook_workers = int(os.getenv('WEBHOOK_WORKERS', 1))
+worker_index = 0
+worker_count = 1
+# Where handled update_ids are remembered: 'sqlite' (the bot's database) or a redis:// URL. Only this dedupe can live
+# off the host; Redis here doesn't make the bot scale past one.
+update_log_url = os.getenv('UPDATE_LOG', 'sqlite')
+update_log_ttl = 86400  # Telegram stops redelivering an update after a day
+update_log_prune_every = 1000
+# Point at a local Bot API server (or a mock) with e.g. http://localhost:8081/bot{0}/{1}
+if api_url := os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = api_url
+
 bot = telebot.TeleBot(API_TOKEN, parse_mode='Markdown')
+async_bot = None
+event_loop = None
+
+# Outbound messages are paced per chat with a token bucket, to Telegram's limits: about one message a second in a
+# private chat and 20 a minute in a group (negative chat IDs). A 429 that gets through anyway pauses the chat.
+chat_rate = float(os.getenv('CHAT_MESSAGES_PER_SEC', 1))
+group_rate = float(os.getenv('GROUP_MESSAGES_PER_MIN', 20)) / 60
+chat_burst = int(os.getenv('CHAT_BURST', 3))
+send_threads = int(os.getenv('SEND_THREADS', 8))
+send_retries = 5
+# When > 0, "Thanks for taking on X" replies for the same bounty are held this long and sent as one message
+coalesce_window = float(os.getenv('COALESCE_WINDOW_SEC', 0))
+outbox = {}  # chat_id -> pending messages and rate limit state
+outbox_cv = threading.Condition()
+# What Telegram answers with when it turns a send down; run_async() adds the async client's, which isn't a subclass
+api_errors = (ApiTelegramException,)
+dispatcher = None
+send_pool = None
+
+# Per-command counts and timings, cheap enough to leave on; METRICS=0 skips even that
+metrics_enabled = os.getenv('METRICS', '1') != '0'
+metrics_listen = os.getenv('METRICS_LISTEN', '127.0.0.1')
+metrics_port = int(os.getenv('METRICS_PORT', 0))  # Prometheus text format at /metrics when set
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+metrics = {
+    'commands'  : {},  # command -> counts, seconds per phase and latency buckets
+    'statements': {},  # SQL text -> [executions, seconds]
+    'sends'     : {'count': 0, 'errors': 0, 'seconds': 0}
+}
+metrics_lock = threading.Lock()
+request_timings = contextvars.ContextVar('request_timings', default=None)  # Phase timings of the running command
+
+def reply_to(message, text, **kwargs):
+    return enqueue({'chat_id': message.chat.id, 'reply_to': message, 'text': text, 'kwargs': kwargs})
+
+def send_message(chat_id, text, **kwargs):
+    return enqueue({'chat_id': chat_id, 'reply_to': None, 'text': text, 'kwargs': kwargs})
+
+def send_photo(chat_id, photo, caption, **kwargs):
+    return enqueue({'chat_id': chat_id, 'reply_to': None, 'text': caption, 'kwargs': kwargs, 'photo': photo})
+
+def send_coalesced(chat_id, key, part, render):
+    """
+    Send render([part]) to the chat, or fold part into a message for the same key that hasn't gone out yet.
+    Without a coalesce window this is just a plain send.
+    """
+    if not coalesce_window:
+        return send_message(chat_id, render([part]))
+
+    return enqueue({'chat_id': chat_id, 'reply_to': None, 'text': None, 'kwargs': {},
+                    'coalesce': key, 'parts': [part], 'render': render})
 
 def admin_command(f):
     def wrapper(*args, **kwargs):
@@ -50,39 +286,387 @@ def admin_command(f):
         if is_admin(message.from_user):
             return f(*args, **kwargs)
         else:
-            bot.reply_to(message, "🙅‍♂️ This is an administrator command!!")
+            reply_to(message, "🙅‍♂️ This is an administrator command!!")
+
+    return wrapper
+
+def instrumented(f):
+    # Counts the command and splits its wall time into parsing and database phases (see timed()). Its replies carry
+    # the command name, so transmit() adds their send time to it even when they go out after the handler returns.
+    def wrapper(message):
+        if not metrics_enabled:
+            return f(message)
+
+        command_text = message.text or message.caption or '/document'
+        timings = {'command': command_text.split()[0][1:].split('@')[0], 'phase': None, 'parse': 0, 'db': 0,
+                   'failed': False}  # enqueue() sets failed when the handler answers with general_error
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = f(message)
+            failed = timings['failed']
+            return result
+        finally:
+            request_timings.reset(token)
+            record_command(timings['command'], time.perf_counter() - started, timings, failed)
 
     return wrapper
 
-def num_arguments(required=0):
+def timed(phase):
+    # Adds time spent in the function to the running command's phase; nested calls count toward the outer phase
     def outer_wrapper(f):
         def wrapper(*args, **kwargs):
-            message = args[0]
-            if len(shlex.split(fix_quotes(message.text))) == required + 1:
+            if (timings := request_timings.get()) is None or timings['phase'] is not None:
                 return f(*args, **kwargs)
-            else:
-                bot.reply_to(message, f"🙅‍♂️ This command requires exactly {pluralize(required, 'argument')}! "
-                                      f"Wrap quotes around text with spaces!")
+
+            timings['phase'] = phase
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                timings[phase] += time.perf_counter() - started
+                timings['phase'] = None
 
         return wrapper
 
     return outer_wrapper
 
+def chat_scoped(f):
+    # Runs the handler against the state of the chat the message came from
+    def wrapper(message):
+        with chat_scope(message.chat.id):
+            return f(message)
+
+    return wrapper
+
+# Argument kinds for @command; a kind can also be given as (kind, error message)
+MENTION = 'mention'  # @username or a text mention, resolved to a registered User
+NUMBER = 'number'    # Positive integer
+TEXT = 'text'        # A single token; quote it if it has spaces
+BOUNTY = 'bounty'    # ID or name of a bounty; takes the rest of the line, so no quotes needed
+REST = 'rest'        # Whatever tokens are left, as a list
+AMOUNTS = 'amounts'  # One or more `@user N` pairs; takes the rest of the line, see collect_amounts()
+TEXT_MENTION = '@\u2060'  # Stands in for a text mention while tokenizing
+
+class ArgumentError(ValueError):
+    pass
+
+def command(*schema):
+    """
+    Tokenizes the message once, checks it against schema and calls the handler as f(message, *parsed_args).
+    Anything that doesn't fit gets a reply explaining why and the handler never runs.
+    """
+    def outer_wrapper(f):
+        def wrapper(message):
+            try:
+                args = parse_arguments(message, schema)
+            except ArgumentError as e:
+                return reply_to(message, str(e))
+
+            return f(message, *args)
+
+        return wrapper
+
+    return outer_wrapper
+
+def tokenize(message: telebot.types.Message):
+    text = fix_quotes(message.text)
+
+    # A text mention is a display name that may contain spaces; collapse each one into a single token
+    for entity in reversed(message.entities or []):
+        if entity.type == 'text_mention':
+            text = text[:entity.offset] + TEXT_MENTION + text[entity.offset + entity.length:]
+
+    # Fast path: nothing to unquote
+    if '"' not in text and "'" not in text:
+        return text.split()
+
+    try:
+        return shlex.split(text)
+    except ValueError:
+        # Unbalanced quotes are nearly always an apostrophe ("Bob's job"), not an attempt at quoting
+        return text.split()
+
+@timed('parse')
+def parse_arguments(message: telebot.types.Message, schema):
+    tokens = tokenize(message)[1:]
+    text_mentions = iter([entity for entity in message.entities or [] if entity.type == 'text_mention'])
+    kinds = [spec[0] if isinstance(spec, tuple) else spec for spec in schema]
+
+    if kinds and kinds[-1] == REST:
+        valid = len(tokens) >= len(kinds) - 1
+    elif kinds and kinds[-1] == AMOUNTS:
+        valid = len(tokens) > len(kinds) - 1 and (len(tokens) - len(kinds) + 1) % 2 == 0
+    elif kinds and kinds[-1] == BOUNTY:
+        valid = len(tokens) >= len(kinds)
+    else:
+        valid = len(tokens) == len(kinds)
+
+    if not valid and kinds and kinds[-1] == AMOUNTS:
+        raise ArgumentError("🙅‍♂️ Give a number of shares after each user, like `@user 5 @other 3`!")
+    if not valid:
+        raise ArgumentError(f"🙅‍♂️ This command requires {pluralize(len(kinds), 'argument')}! "
+                            f"Wrap quotes around text with spaces!")
+
+    args = []
+    for i, spec in enumerate(schema):
+        kind, error = spec if isinstance(spec, tuple) else (spec, None)
+        token = indexof(tokens, i)
+
+        if kind == MENTION:
+            if token == TEXT_MENTION:
+                value = runtime()['users'].get(next(text_mentions).user.id)
+            else:
+                value = find_user_by_name(token) if token.startswith('@') else None
+
+            if value is None:
+                raise ArgumentError(error or strings['unknown_target'])
+        elif kind == NUMBER:
+            if (value := parse_int(token)) is None or value < 1:
+                raise ArgumentError(error or f"`{token}` needs to be a positive number!")
+        elif kind == BOUNTY:
+            value = resolve_bounty(' '.join(tokens[i:]))
+        elif kind == REST:
+            value = tokens[i:]
+        elif kind == AMOUNTS:
+            entries = []
+            for token, amount in zip(tokens[i::2], tokens[i + 1::2]):
+                if token == TEXT_MENTION:
+                    entries.append(('that mention', runtime()['users'].get(next(text_mentions).user.id), amount))
+                else:
+                    entries.append((f"`{token}`", find_user_by_name(token) if token.startswith('@') else None, amount))
+            value = collect_amounts(entries, error)
+        else:
+            value = token
+
+        args.append(value)
+
+    return args
+
+def collect_amounts(entries, error=None):
+    """
+    Checks (label, user or None, amount text) entries all at once and returns {telegram_id: (user, shares)}, adding
+    up users named more than once. Raises ArgumentError listing every entry that doesn't check out.
+    """
+    amounts = {}
+    problems = []
+    for label, user, amount in entries:
+        if user is None:
+            problems.append(f"{label}: {strings['unknown_target']}")
+        elif (shares := parse_int(amount)) is None or shares < 1:
+            problems.append(f"{label}: {error or f'`{amount}` needs to be a positive number!'}")
+        else:
+            amounts[user.telegram_id] = (user, amounts.get(user.telegram_id, (user, 0))[1] + shares)
+
+    if problems:
+        raise ArgumentError('\n'.join(problems[:10]) +
+                            (f"\n...and {len(problems) - 10} more" if len(problems) > 10 else '') +
+                            ("\nNothing was changed." if len(entries) > 1 else ''))
+
+    return amounts
+
+def resolve_bounty(ref) -> Bounty:
+    """
+    Finds a bounty by ID (open or not), or an open bounty by name: exact, then case-insensitive, then unique prefix.
+    Raises ArgumentError with suggestions when a prefix matches more than one.
+    """
+    if bounty_id := parse_int(ref):
+        if (bounty := get_bounty(bounty_id)) is None:
+            raise ArgumentError(f"Bounty ID {bounty_id} does not exist!")
+        return bounty
+
+    key = name_key(ref)
+    with state_lock:
+        if (result := runtime()['bounty_refs'].get(key)) is None:
+            result = match_bounty_name(ref, key)
+
+            if len(runtime()['bounty_refs']) >= bounty_refs_size:
+                runtime()['bounty_refs'].clear()
+            runtime()['bounty_refs'][key] = result
+
+    if isinstance(result, str):
+        raise ArgumentError(result)
+
+    return result
+
+def match_bounty_name(ref, key):
+    # Returns the bounty, or the message explaining why there isn't one
+    if (bounty := runtime()['active_bounties'].get(key)) is not None:
+        return bounty
+
+    names = runtime()['bounty_names']
+    start = bisect.bisect_left(names, key)
+    matches = names[start:bisect.bisect_left(names, key + '\U0010ffff', start)]
+
+    if len(matches) == 1:
+        return runtime()['active_bounties'][matches[0]]
+
+    if not matches:
+        return f"There is no open bounty named `{ref}`!"
+
+    suggestions = [runtime()['active_bounties'][name] for name in matches[:5]]
+    return f"`{ref}` could be a few bounties. Did you mean " + \
+        ', '.join(f"{bounty.bounty_id}: `{bounty.name}`" for bounty in suggestions) + \
+        (f" or one of {len(matches) - len(suggestions)} others" if len(matches) > len(suggestions) else '') + "?"
+
+def has_role(telegram_id, role):
+    return telegram_id in owner_ids or telegram_id in runtime()['roles'][role]
+
 def is_admin(user: telebot.types.User):
-    return runtime['users'].get(user.id, {}).get('is_admin', 0) or parse_user(user) in admin_usernames
+    return has_role(user.id, 'admin') or chat_admin_sync and user.id in telegram_admins(runtime()['chat_id'])
+
+def telegram_admins(chat_id):
+    # Private chats have no administrators to ask about
+    if chat_id > 0:
+        return set()
+
+    if (cached := chat_admins.get(chat_id)) is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    try:
+        admins = {member.user.id for member in bot.get_chat_administrators(chat_id)}
+    except Exception as e:
+        # Keep whatever we knew (or nobody) for a full TTL rather than asking again on every command
+        logger.warning('chat administrators', exc_info=e)
+        admins = cached[1] if cached is not None else set()
+
+    chat_admins[chat_id] = (time.monotonic() + chat_admin_ttl, admins)
+    return admins
+
+def name_key(name):
+    # Telegram usernames are case-insensitive, and mentions come in with the leading @
+    return str(name).lstrip('@').casefold()
+
+def index_user(user: User):
+    runtime()['users'][user.telegram_id] = user
+    runtime()['usernames'][name_key(user.username)] = user
+
+    with state_lock:
+        board = runtime()['leaderboard']
+        bisect.insort(board['ranking'], (-user.shares, user.telegram_id))
+        board['total'] += user.shares
+        board['cache'].clear()
+        runtime()['log_versions'][None] += 1
+
+def rename_user(user: User, username):
+    if user.username == username:
+        return
+
+    try:
+        persist(("UPDATE users SET username = ? WHERE chat_id = ? AND telegram_id = ?;",
+                 (username, runtime()['chat_id'], user.telegram_id)))
+    except sqlite3.Error as e:
+        logger.warning('rename_user', exc_info=e)
+        return
+
+    if runtime()['usernames'].get(name_key(user.username)) is user:
+        del runtime()['usernames'][name_key(user.username)]
+
+    user.username = username
+    runtime()['usernames'][name_key(username)] = user
+    runtime()['leaderboard']['cache'].clear()
+
+def index_bounty(bounty: Bounty):
+    runtime()['bounties'][bounty.bounty_id] = bounty
+    if not bounty.is_active:
+        return
+
+    with state_lock:
+        if (key := name_key(bounty.name)) not in runtime()['active_bounties']:
+            bisect.insort(runtime()['bounty_names'], key)
+        runtime()['active_bounties'][key] = bounty
+        runtime()['bounty_refs'].clear()
+
+def unindex_bounty(bounty: Bounty):
+    with state_lock:
+        if runtime()['active_bounties'].get(key := name_key(bounty.name)) is bounty:
+            del runtime()['active_bounties'][key]
+            del runtime()['bounty_names'][bisect.bisect_left(runtime()['bounty_names'], key)]
+            runtime()['bounty_refs'].clear()
 
 def find_bounty_by_name(bounty_name, require_active=True) -> dict:
-    if require_active:
-        res = [item for item in runtime['bounties'].values() if item['name'] == bounty_name and item['is_active']]
-    else:
-        res = [item for item in runtime['bounties'].values() if item['name'] == bounty_name]
+    if (bounty := runtime()['active_bounties'].get(name_key(bounty_name))) or require_active:
+        return bounty
+
+    # Ended bounties aren't in memory; this is only for the rare historical lookup
+    rows = read_query("SELECT bounty_id FROM bounties WHERE chat_id = ? AND name = ? COLLATE NOCASE "
+                      "ORDER BY bounty_id DESC LIMIT 1", (runtime()['chat_id'], str(bounty_name)))
+
+    return get_bounty(rows[0]['bounty_id']) if rows else None
+
+def get_bounty(bounty_id):
+    if (bounty := runtime()['bounties'].get(bounty_id)) is not None:
+        return bounty
 
-    return next(iter(res), None)
+    if (entry := historical_bounty(bounty_id)) is not None:
+        return entry[0]
+
+def participants(bounty_id):
+    if bounty_id in runtime()['bounties']:
+        return runtime()['participation'][bounty_id]
+
+    if (entry := historical_bounty(bounty_id)) is not None:
+        return entry[1]
+
+    return {}
+
+def historical_bounty(bounty_id):
+    history = runtime()['bounty_history']
+    with state_lock:
+        if (entry := history.get(bounty_id)) is not None:
+            history.move_to_end(bounty_id)
+            return entry
+
+    if not (rows := read_query("SELECT * FROM bounties WHERE bounty_id = ? AND chat_id = ?",
+                               (bounty_id, runtime()['chat_id']))):
+        return None
+
+    participation = dict.fromkeys(row['telegram_id'] for row in
+                                  read_query("SELECT telegram_id FROM participation WHERE bounty_id = ? ORDER BY rowid",
+                                             (bounty_id,)))
+
+    return remember_bounty(Bounty.from_row(rows[0]), participation)
+
+def remember_bounty(bounty: Bounty, participation):
+    history = runtime()['bounty_history']
+    with state_lock:
+        entry = history[bounty.bounty_id] = (bounty, participation)
+        history.move_to_end(bounty.bounty_id)
+        while len(history) > bounty_history_size:
+            history.popitem(last=False)
+
+    return entry
+
+def adjust_shares(user: User, amount):
+    with state_lock:
+        board = runtime()['leaderboard']
+        ranking = board['ranking']
+
+        del ranking[bisect.bisect_left(ranking, (-user.shares, user.telegram_id))]
+        user.shares += amount
+        bisect.insort(ranking, (-user.shares, user.telegram_id))
+
+        board['total'] += amount
+        board['cache'].clear()
+
+        # Every change has a log row, so cached history for the user (and the chat) is out of date
+        runtime()['log_versions'][user.telegram_id] += 1
+        runtime()['log_versions'][None] += 1
+
+def muscle_list(bounty_id):
+    return [escape_username(runtime()['users'][k].username) for k in
+            participants(bounty_id) if k in runtime()['users']]
 
 def find_user_by_name(search):
-    results = [user for user in runtime['users'].values() if user['username'] == search]
+    return runtime()['usernames'].get(name_key(search))
+
+def sender(message: telebot.types.Message):
+    # Returns the registered user behind a message, picking up any username change along the way
+    if (user := runtime()['users'].get(message.from_user.id)) is not None:
+        rename_user(user, parse_user(message.from_user))
 
-    return next(iter(results), None)
+    return user
 
 def now():
     return int(datetime.datetime.now().timestamp())
@@ -114,17 +698,6 @@ def parse_int(val):
 
     return val
 
-def user_from_mention(message: telebot.types.Message):
-    if len(message.entities) < 2:
-        return None
-
-    entity = message.entities[1]
-
-    if entity.type == 'text_mention':
-        return runtime['users'].get(entity.user.id, None)
-
-    return find_user_by_name(message.text[entity.offset + 1:entity.offset + entity.length])
-
 def parse_user(user: telebot.types.User):
     return user.username or user.first_name
 
@@ -142,39 +715,89 @@ def indexof(lst, idx):
 
     return res
 
-def get_setting(key):
-    return runtime['settings'].get(key, None)
+def parse_count(text):
+    if (value := parse_int(text)) is None or value < 0:
+        raise ValueError('needs to be a whole number, 0 or more')
+    return value
+
+def parse_money(text):
+    if (match := re.fullmatch(r'([^\d\s.,-]*)\s*(\d[\d,]*(?:\.\d+)?)\s*([^\d\s]*)', text.strip())) is None:
+        raise ValueError('needs to be an amount like `$100` or `250 USDC`')
+    symbol, amount, unit = match.groups()
+    return Money(f"{symbol}{amount}" + (f" {unit}" if unit else ''))
+
+def parse_duration(text):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if (match := re.fullmatch(r'(\d+)\s*([smhdw]?)', text.strip().lower())) is None or not int(match[1]):
+        raise ValueError('needs to be a length of time like `90` (minutes), `45m`, `12h` or `3d`')
+    return Duration(int(match[1]) * units[match[2] or 'm'])
+
+setting_kinds = {
+    # type -> (parse the text an admin typed, show the parsed value)
+    int     : (parse_count, str),
+    Money   : (parse_money, str),
+    Duration: (parse_duration, display_time)
+}
+setting_types = {field.name: field.type for field in fields(Settings)}
+setting_watchers = defaultdict(list)  # setting name -> f(old, new), run in the chat whose setting changed
+
+def on_setting_change(*names):
+    def outer_wrapper(f):
+        for name in names:
+            setting_watchers[name].append(f)
+        return f
+
+    return outer_wrapper
+
+def parse_setting(name, text):
+    # Raises KeyError for a setting that doesn't exist and ValueError for a value that doesn't fit it
+    return setting_kinds[setting_types[name]][0](text)
+
+def show_setting(settings: Settings, name):
+    return setting_kinds[setting_types[name]][1](getattr(settings, name))
 
 def escape_username(username):
     return username.replace("_", "\\_").replace("*", "\\*")
 
 @bot.message_handler(commands=['help'])
+@instrumented
+@chat_scoped
 def help_message(message):
     resp = """
 Interacting with the Bounty system:
 
 *User Commands*:
 `/register` |  Initial registration
-`/leaderboard` |  Show the Leaderboard
+`/leaderboard {page|top N}` |  Show the Leaderboard
 `/bountylist` | List the active Bounties
 `/onthejob {bounty}` | Register for an active Bounty
 `/abandon {bounty}` | Concede participation from an active Bounty
 `/bump {@User}` | Fistbump and add a share to a user
+`/history {@User} [days]` | Chart a user's shares over time
+`/trend [days]` | Chart the group's shares over time
 """
     if is_admin(message.from_user):
         resp += """
 *Admin Commands*:
-`/grant {@User} {shares}` | Grant Shares
-`/addbounty {"name"} {cred_value} {time_limit}` | Add a new Bounty
+`/grant {@User} {shares} ...` | Grant Shares, to as many users as you like
+`/addbounty {"name"} {cred_value} [time_limit]` | Add a new Bounty
+`/config {get|set|show} [setting] [value]` | Read or change settings
 `/endbounty {"name"|id}` | End a Bounty
-`/cashout {@User} {shares}` | Redeem Shares for User
-`/audit {id}` | Show stats for Bounty
-`/showlog {@User}` | Show Balance changes
+`/cashout {@User} {shares} ...` | Redeem Shares for Users
+Send a CSV of `user,shares` lines captioned `/grant` or `/cashout` for big payouts
+`/audit {"name"|id}` | Show stats for Bounty
+`/showlog {@User} [page N]` | Show Balance changes
+`/stats` | Show command and database timings
+`/reconcile` | Check balances against the log and fix any drift
+`/role {add|remove} {role} {@User}` | Give or take away admin or dev
+`/roles` | List who has which role
 """
 
-    bot.reply_to(message, resp, parse_mode='Markdown')
+    reply_to(message, resp, parse_mode='Markdown')
 
 @bot.message_handler(commands=['register'])
+@instrumented
+@chat_scoped
 def register(message):
     user_id = message.from_user.id
     if (username := message.from_user.username) is None:
@@ -182,164 +805,134 @@ def register(message):
 
     esc_username = escape_username(username)
 
-    if user_id in runtime['users']:
-        return bot.reply_to(message, f"{esc_username}, you're already registered!")
+    if sender(message) is not None:
+        return reply_to(message, f"{esc_username}, you're already registered!")
 
-    shares = get_setting('initial_shares')
+    shares = runtime()['settings'].initial_shares
     created_at = now()
 
     # create new entry in the users table
-    sqlite_insert_with_param = "INSERT INTO users (telegram_id, username, shares, created_at) VALUES (?,?,?,?);"
-    data_tuple = (user_id, username, shares, created_at)
+    sqlite_insert_with_param = "INSERT INTO users (chat_id, telegram_id, username, shares, created_at) VALUES (?,?,?,?,?);"
+    data_tuple = (message.chat.id, user_id, username, shares, created_at)
     try:
-        c = db.cursor()
-        c.execute(sqlite_insert_with_param, data_tuple)
-        db.commit()
+        persist((sqlite_insert_with_param, data_tuple), log_entry(user_id, user_id, 'reg', shares))
     except sqlite3.IntegrityError:
         # Somehow already exists, but not accounted for. We'll pretend they're new
-        pass
+        add_log(user_id, user_id, 'reg', shares)
     except sqlite3.Error as e:
-        print('register', e)
-        return bot.reply_to(message, strings['general_error'])
+        logger.error('register', exc_info=e)
+        return reply_to(message, strings['general_error'])
 
-    runtime['users'][user_id] = {'telegram_id': user_id, 'username': username, 'shares': shares,
-                                 'created_at' : created_at}
-
-    add_log(user_id, user_id, 'reg', shares)
+    index_user(User(telegram_id=user_id, username=username, shares=shares, created_at=created_at))
 
     resp = f"Welcome {esc_username}! We've granted you {pluralize(shares, 'share')}!"
-    bot.reply_to(message, resp)
+    reply_to(message, resp)
 
 @bot.message_handler(commands=['addbounty'])
+@instrumented
+@chat_scoped
 @admin_command
-@num_arguments(3)
-def addbounty(message):
-    # Replace smart quotes and treat them as a single argument
-    args = shlex.split(fix_quotes(message.text))
-
-    bounty_name = args[1]
+@command(TEXT, (NUMBER, strings['bounty_value_error']), REST)
+def addbounty(message, bounty_name, bounty_amount, args):
+    # The time limit is optional; without one the bounty runs for the bounty_duration setting
+    if len(args) > 1:
+        return reply_to(message, "Wrap quotes around a bounty name with spaces!")
+    try:
+        bounty_time_limit = parse_duration(args[0]) if args else runtime()['settings'].bounty_duration
+    except ValueError:
+        return reply_to(message, strings['bounty_limit_error'])
 
     # Filter bounty dict by keys to determine whether we have a current bounty
     if find_bounty_by_name(bounty_name) is not None:
-        return bot.reply_to(message, "This bounty already exists!")
-
-    if not (bounty_amount := parse_int(args[2])) or bounty_amount < 1:
-        return bot.reply_to(message, strings['bounty_value_error'])
+        return reply_to(message, "This bounty already exists!")
 
-    if not (bounty_time_limit := parse_int(args[3])) or bounty_time_limit < 1:
-        return bot.reply_to(message, strings['bounty_limit_error'])
-
-    end_time = datetime.datetime.now() + datetime.timedelta(minutes=bounty_time_limit)
+    end_time = datetime.datetime.now() + datetime.timedelta(seconds=bounty_time_limit)
     end_time = int(end_time.timestamp())
     created_at = now()
 
-    sqlite_insert_with_param = "INSERT INTO bounties(name, worth, endtime, created_at) VALUES (?, ?, ?, ?);"
-    data_tuple = (bounty_name, bounty_amount, end_time, created_at)
+    pool = runtime()['settings'].bounty_pool  # Fixed when the bounty is posted, whatever the setting does later
+    sqlite_insert_with_param = "INSERT INTO bounties(name, worth, endtime, created_at, chat_id, pool) VALUES (?, ?, ?, ?, ?, ?);"
+    data_tuple = (bounty_name, bounty_amount, end_time, created_at, message.chat.id, pool)
     try:
-        c = db.cursor()
-        c.execute(sqlite_insert_with_param, data_tuple)
-        bounty_id = c.lastrowid
-        db.commit()
+        bounty_id = persist((sqlite_insert_with_param, data_tuple))
     except sqlite3.IntegrityError as e:
-        print('addbounty integrity error', e)
-        return bot.reply_to(message, strings['general_error'])
+        logger.error('addbounty integrity error', exc_info=e)
+        return reply_to(message, strings['general_error'])
     except sqlite3.Error as e:
-        print('addbounty general error', e)
-        return bot.reply_to(message, strings['general_error'])
+        logger.error('addbounty general error', exc_info=e)
+        return reply_to(message, strings['general_error'])
 
-    runtime['bounties'][bounty_id] = {'bounty_id': bounty_id, 'name': bounty_name, 'worth': bounty_amount,
-                                      'endtime'  : end_time, 'is_active': True, 'created_at': created_at}
+    bounty = Bounty(bounty_id=bounty_id, name=bounty_name, worth=bounty_amount, endtime=end_time,
+                    created_at=created_at, chat_id=message.chat.id, pool=pool)
+    index_bounty(bounty)
+    schedule_expiry(bounty)
 
     response = f"""
 *NEW BOUNTY!*
 
 ID {bounty_id}: `{bounty_name}` now has {pluralize(bounty_amount, 'open spot')} for willing muscle.
-This bounty is open for {display_time(bounty_time_limit * 60)}. GO GO GO!
-"""
+This bounty is open for {display_time(bounty_time_limit)}. GO GO GO!
+""" + (f"{pluralize(pool, 'share')} get split among the muscle when it's done.\n" if pool else '')
 
-    bot.send_message(message.chat.id, response)
+    send_message(message.chat.id, response)
 
 @bot.message_handler(commands=['endbounty'])
+@instrumented
+@chat_scoped
 @admin_command
-@num_arguments(1)
-def endbounty(message):
-    # get the args
-    args = shlex.split(fix_quotes(message.text))
-    bounty_name = args[1]
-
-    bounty_id = parse_int(bounty_name)
-
-    if bounty_id:
-        if (bounty := runtime['bounties'].get(bounty_id)) is None:
-            return bot.reply_to(message, f"Bounty ID {bounty_id} does not exist!")
-    else:
-        if bounty := find_bounty_by_name(bounty_name):
-            bounty_id = bounty['bounty_id']
-        else:
-            return bot.reply_to(message, f"There is no open bounty called `{bounty_name}`!")
+@command(BOUNTY)
+def endbounty(message, bounty):
+    if not bounty.is_active:
+        return reply_to(message, "This bounty has already ended!")
 
     try:
         remove_bounty(bounty)
     except Exception as e:
-        print('endbounty', e)
-        return bot.reply_to(message, strings['general_error'])
-
-    runtime['bounties'][bounty_id]['is_active'] = False
-    runtime['bounties'][bounty_id]['endtime'] = now()
+        logger.error('endbounty', exc_info=e)
+        return reply_to(message, strings['general_error'])
 
-    bot.reply_to(message, "This bounty is ended!")
+    reply_to(message, "This bounty is ended!")
+    if bounty.settlement == 'pending':
+        settle_bounty(bounty)
 
 @bot.message_handler(commands=['audit'])
+@instrumented
+@chat_scoped
 @admin_command
-@num_arguments(1)
-def audit(message):
-    bounty_id = parse_int(message.text.split()[1])
+@command(BOUNTY)
+def audit(message, bounty):
+    bounty_id = bounty.bounty_id
 
-    if bounty_id:
-        if (bounty := runtime['bounties'].get(bounty_id)) is None:
-            return bot.reply_to(message, f"Bounty ID {bounty_id} does not exist!")
-    else:
-        return bot.reply_to(message, f"I don't know anything about Bounty ID {bounty_id}.")
-
-    running_time = f"Ends in {display_time(bounty['endtime'] - now())}" if (
-                bounty['is_active'] and bounty['endtime'] > now()) \
-        else f"Ran for {display_time(bounty['endtime'] - bounty['created_at'])}"
+    running_time = f"Ends in {display_time(bounty.endtime - now())}" if (
+                bounty.is_active and bounty.endtime > now()) \
+        else f"Ran for {display_time(bounty.endtime - bounty.created_at)}"
 
-    participation_list = [escape_username(runtime['users'][k]['username']) for k in
-                          runtime['participation'][bounty_id] if k in runtime['users']]
+    participation_list = muscle_list(bounty_id)
 
     response = f"""
-Bounty {bounty['bounty_id']}:  `{bounty['name']}`
-Created {str(datetime.datetime.fromtimestamp(bounty['created_at']))}
+Bounty {bounty.bounty_id}:  `{bounty.name}`
+Created {str(datetime.datetime.fromtimestamp(bounty.created_at))}
 {running_time}
 
-Muscle ({len(participation_list)}/{bounty['worth']}): {', '.join(participation_list)}
-"""
+Muscle ({len(participation_list)}/{bounty.worth}): {', '.join(participation_list)}
+""" + (f"Pool: {pluralize(bounty.pool, 'share')}, {bounty.settlement or 'paid when it ends'}\n" if bounty.pool else '')
 
-    bot.reply_to(message, response)
+    reply_to(message, response)
 
 @bot.message_handler(commands=['showlog'])
+@instrumented
+@chat_scoped
 @admin_command
-@num_arguments(1)
-def showlog(message):
-    user = user_from_mention(message)
-
-    if user is None:
-        return bot.reply_to(message, strings['unknown_target'])
-
-    query = "SELECT CASE WHEN from_id = to_id THEN '<Self>' ELSE u.username END AS username, " \
-            "CASE WHEN subject THEN action || ' (' || subject || ')' ELSE action END AS action, " \
-            "amount, at FROM log " \
-            "INNER JOIN users u ON u.telegram_id = from_id " \
-            "WHERE to_id = ? ORDER BY at DESC LIMIT 15"
-
-    cursor = db.cursor()
-    cursor.execute(query, (user['telegram_id'],))
+@command(MENTION, REST)
+def showlog(message, user, args):
+    page = 1
+    if args and (len(args) != 2 or args[0] != 'page' or (page := parse_int(args[1])) is None or page < 1):
+        return reply_to(message, "Use `/showlog @user page {number}`")
 
-    results = [dict(row) for row in cursor.fetchall()]
+    results = list(itertools.islice(log_history(user.telegram_id, (page - 1) * showlog_page_size), showlog_page_size))
 
     if not len(results):
-        return bot.reply_to(message, f"No logs for this user")
+        return reply_to(message, f"No logs for this user" + (f" on page {page}" if page > 1 else ''))
 
     maxlength = {
         'username': len(max(results, key=lambda x: len(x['username']))['username']),
@@ -355,151 +948,321 @@ def showlog(message):
                  f"{str(row['amount']).ljust(maxlength['amount'])} | " \
                  f"{datetime.datetime.fromtimestamp(row['at']).strftime('%b-%d %H:%M')}\n"
 
+    first = (page - 1) * showlog_page_size + 1
+    title = f"Last {len(results)} Updates" if page == 1 else f"Updates {first}-{first + len(results) - 1}"
+
     response = f"""
-Last {len(results)} Updates for {escape_username(user['username'])}
+{title} for {escape_username(user.username)}
 
 ```
 {table}
 ```
 """
-    bot.reply_to(message, response)
+    reply_to(message, response)
+
+def log_history(telegram_id, skip=0):
+    """
+    Yields the user's log entries newest first for /showlog: the live table, then the archive, as one stream.
+    The first skip entries are stepped over without reading them where the indexes allow.
+    """
+    chat_id = runtime()['chat_id']
+    query = "SELECT CASE WHEN from_id = to_id THEN '<Self>' ELSE COALESCE(u.username, '#' || from_id) END AS username, " \
+            "CASE WHEN subject THEN action || ' (' || subject || ')' ELSE action END AS action, " \
+            "amount, at, log.rowid AS rowid FROM log " \
+            "LEFT JOIN users u ON u.chat_id = log.chat_id AND u.telegram_id = from_id " \
+            "WHERE log.chat_id = ? AND to_id = ? AND (at < ? OR (at = ? AND log.rowid > ?)) " \
+            "ORDER BY at DESC, log.rowid LIMIT ?"
+
+    position = (now() + 1, 0)  # Keyset: continue after (at, rowid)
+    if skip:
+        # Find where to start by walking log(chat_id, to_id, at DESC) alone (no join, no sort)
+        rows = read_query("SELECT at, rowid FROM log WHERE chat_id = ? AND to_id = ? ORDER BY at DESC, rowid "
+                          "LIMIT 1 OFFSET ?", (chat_id, telegram_id, skip))
+        if rows:
+            position, skip = (rows[0]['at'], rows[0]['rowid'] - 1), 0
+        else:
+            position = None
+            skip -= read_query("SELECT COUNT(*) AS entries FROM log WHERE chat_id = ? AND to_id = ?",
+                               (chat_id, telegram_id))[0]['entries']
+
+    while position is not None:
+        rows = read_query(query, (chat_id, telegram_id, position[0], position[0], position[1], showlog_page_size))
+        yield from (dict(row) for row in rows)
+        position = (rows[-1]['at'], rows[-1]['rowid']) if len(rows) == showlog_page_size else None
+
+    yield from archived_history(chat_id, telegram_id, skip)
+
+def archived_history(chat_id, telegram_id, skip):
+    # Segments the user has no entries in are never opened, and ones that are wholly skipped aren't either
+    segments = read_query("SELECT s.path, su.entries FROM log_segment_users su "
+                          "INNER JOIN log_segments s ON s.segment_id = su.segment_id "
+                          "WHERE su.chat_id = ? AND su.telegram_id = ? ORDER BY su.segment_id DESC",
+                          (chat_id, telegram_id))
+
+    for segment in segments:
+        if segment['entries'] <= skip:
+            skip -= segment['entries']
+            continue
+
+        with gzip.open(os.path.join(archive_root, segment['path']), 'rt', encoding='utf-8') as f:
+            rows = [row for row in map(json.loads, f) if row['chat_id'] == chat_id and row['to_id'] == telegram_id]
+        rows.sort(key=lambda row: (-row['at'], row['rowid']))
+
+        for row in rows[skip:]:
+            sender = runtime()['users'].get(row['from_id'])
+            yield {
+                'username': '<Self>' if row['from_id'] == row['to_id'] else
+                            sender.username if sender is not None else f"#{row['from_id']}",
+                'action'  : f"{row['action']} ({row['subject']})" if row['subject'] else row['action'],
+                'amount'  : row['amount'],
+                'at'      : row['at']
+            }
+        skip = 0
+
+@bot.message_handler(commands=['history'])
+@instrumented
+@chat_scoped
+@command(MENTION, REST)
+def history(message, user, args):
+    if (days := history_days(args)) is None:
+        return reply_to(message, f"Use `/history @user [days]`, up to {history_max_days} days")
+
+    show_history(message, user, days)
+
+@bot.message_handler(commands=['trend'])
+@instrumented
+@chat_scoped
+@command(REST)
+def trend(message, args):
+    if (days := history_days(args)) is None:
+        return reply_to(message, f"Use `/trend [days]`, up to {history_max_days} days")
+
+    show_history(message, None, days)
+
+def history_days(args):
+    if not args:
+        return history_default_days
+    if len(args) == 1 and (days := parse_int(args[0])) is not None and 0 < days <= history_max_days:
+        return days
+
+def show_history(message, user, days):
+    # A repeat request is answered from the cache until a balance changes or the day turns over
+    telegram_id = user.telegram_id if user is not None else None
+    today = datetime.datetime.now(datetime.timezone.utc).date()  # log_daily days are UTC
+    cache = runtime()['history']
+
+    with state_lock:
+        key = (telegram_id, days, today, runtime()['log_versions'][telegram_id])
+        if (rendered := cache.get(key)) is not None:
+            cache.move_to_end(key)
+
+    if rendered is None:
+        rendered = render_history(user, days, today)
+        with state_lock:
+            cache[key] = rendered
+            while len(cache) > history_cache_size:
+                cache.popitem(last=False)
+
+    photo, text = rendered
+    if photo is not None:
+        return send_photo(message.chat.id, photo, text)
+
+    send_message(message.chat.id, text)
+
+def daily_changes(telegram_id, since):
+    # {day: (net change, log entries)} from log_daily, for a user or (telegram_id None) the whole chat
+    if telegram_id is None:
+        rows = read_query("SELECT day, SUM(amount) AS amount, SUM(entries) AS entries FROM log_daily "
+                          "WHERE chat_id = ? AND day >= ? GROUP BY day", (runtime()['chat_id'], since))
+    else:
+        rows = read_query("SELECT day, SUM(amount) AS amount, SUM(entries) AS entries FROM log_daily "
+                          "WHERE chat_id = ? AND telegram_id = ? AND day >= ? GROUP BY day",
+                          (runtime()['chat_id'], telegram_id, since))
+
+    return {row['day']: (row['amount'], row['entries']) for row in rows}
+
+def render_history(user, days, today):
+    # Returns (PNG or None, text): the text is the caption, or the whole answer without matplotlib
+    dates = [today - datetime.timedelta(days=days - 1 - i) for i in range(days)]
+    totals = daily_changes(user.telegram_id if user is not None else None, dates[0].isoformat())
+    changes = [totals.get(date.isoformat(), (0, 0))[0] for date in dates]
+
+    # Walk back from today's balance to get each day's closing balance
+    balance = user.shares if user is not None else runtime()['leaderboard']['total']
+    balances = []
+    for change in reversed(changes):
+        balances.append(balance)
+        balance -= change
+    balances.reverse()
+
+    title = f"{escape_username(user.username)}'s shares" if user is not None else "Shares across the group"
+    summary = f"*{title}*, last {pluralize(days, 'day')}: {balance} → {balances[-1]} ({balances[-1] - balance:+})"
+
+    if (photo := history_chart(title.replace('\\', ''), dates, balances, changes)) is not None:
+        return photo, summary
+
+    # Text fallback: a sparkline of closing balances and the most recent days that had changes
+    bars = '▁▂▃▄▅▆▇█'
+    low, high = min(balances), max(balances)
+    spark = ''.join(bars[(value - low) * 7 // (high - low) if high > low else 0] for value in balances)
+    active = [(date, change, value) for date, change, value in zip(dates, changes, balances) if change][-10:]
+    day_list = ''.join(f"{date.strftime('%b %d')} | {change:+} | {value}\n" for date, change, value in active)
+
+    return None, f"""
+{summary}
+
+```
+{spark}
+{day_list.rstrip() or 'No changes in this range'}
+```
+"""
+
+def history_chart(title, dates, balances, changes):
+    # matplotlib is optional; without it (or if drawing fails) the history goes out as text
+    try:
+        from matplotlib.figure import Figure
+    except ImportError:
+        return None
+
+    try:
+        figure = Figure(figsize=(8, 4), dpi=100)
+        balance_axis = figure.subplots()
+        change_axis = balance_axis.twinx()
+        change_axis.bar(dates, changes, color=['tab:green' if change >= 0 else 'tab:red' for change in changes],
+                        alpha=0.3)
+        change_axis.set_ylabel('Change')
+        balance_axis.plot(dates, balances, color='tab:blue')
+        balance_axis.set_ylabel('Shares')
+        balance_axis.set_zorder(change_axis.get_zorder() + 1)
+        balance_axis.patch.set_visible(False)
+        balance_axis.set_title(title)
+        figure.autofmt_xdate()
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+        return buffer.getvalue()
+    except Exception as e:
+        logger.warning('history chart', exc_info=e)
+        return None
 
 @bot.message_handler(commands=['onthejob'])
-@num_arguments(1)
-def onthejob(message):
-    # get the args
-    args = str(message.text).split()
-    bounty_name = ' '.join(args[1:])  # Don't require quotes since it's a single argument
+@instrumented
+@chat_scoped
+@command(BOUNTY)
+def onthejob(message, bounty):
     user_id = message.from_user.id
-    shares = get_setting('otj_shares')
+    shares = runtime()['settings'].otj_shares
 
-    if (user := runtime['users'].get(user_id)) is None:
-        return bot.reply_to(message, strings['unknown_user'])
+    if (user := sender(message)) is None:
+        return reply_to(message, strings['unknown_user'])
 
-    if bounty_id := parse_int(bounty_name):
-        if (bounty := runtime['bounties'].get(bounty_id, None)) is None:
-            return bot.reply_to(message, f"Bounty ID {bounty_id} does not exist!")
-    else:
-        if (bounty := find_bounty_by_name(bounty_name)) is None:
-            return bot.reply_to(message, f"There is no open bounty named `{bounty_name}`!")
-
-    if not bounty['is_active']:
-        return bot.reply_to(message, 'This bounty has ended!')
+    if not bounty.is_active:
+        return reply_to(message, 'This bounty has ended!')
 
-    # If we get this far, the bounty is still active and we'll disable it
-    if bounty['endtime'] < now():
-        remove_bounty(bounty)
-        return bot.reply_to(message, 'This bounty has ended!')
+    # The scheduler closes it any moment now
+    if bounty.endtime <= now():
+        return reply_to(message, 'This bounty has ended!')
 
-    if (bounty_participation := runtime['participation'][bounty['bounty_id']]) and user_id in bounty_participation:
-        return bot.reply_to(message, strings['participating'])
+    bounty_participation = runtime()['participation'][bounty.bounty_id]
+    with state_lock:
+        if user_id in bounty_participation:
+            error = strings['participating']
+        elif len(bounty_participation) >= bounty.worth:
+            error = strings['bounty_full']
+        else:
+            # Hold the spot while the write is in flight so concurrent joins can't overfill the bounty
+            error = None
+            bounty_participation[user_id] = None
 
-    if len(bounty_participation) >= bounty['worth']:
-        return bot.reply_to(message, strings['bounty_full'])
+    if error:
+        return reply_to(message, error)
 
-    c = db.cursor()
-    sqlite_insert_with_param = "INSERT INTO participation(telegram_id, bounty_id) VALUES (?, ?);"
-    data_tuple = (user_id, bounty['bounty_id'])
     try:
-        c.execute(sqlite_insert_with_param, data_tuple)
-    except sqlite3.IntegrityError as e:
-        print('onthejob', e)
-        return
+        persist(("INSERT INTO participation(telegram_id, bounty_id) VALUES (?, ?);", (user_id, bounty.bounty_id)),
+                share_change(user_id, shares),
+                log_entry(user_id, user_id, 'otj', shares, bounty.bounty_id))
     except sqlite3.Error as e:
-        print('onthejob general', e)
+        logger.error('onthejob', exc_info=e)
+        with state_lock:
+            del bounty_participation[user_id]
         return
 
-    sqlite_insert_with_param = "UPDATE users SET shares = shares + ? WHERE telegram_id = ?;"
-    data_tuple = (shares, user_id)
-    try:
-        c.execute(sqlite_insert_with_param, data_tuple)
-    except sqlite3.Error as e:
-        print(e)
-        return
+    adjust_shares(user, shares)
 
-    db.commit()
-    user['shares'] += shares
-    bounty_participation.append(user_id)
+    if coalesce_window:
+        name = bounty.name
+        return send_coalesced(message.chat.id, ('otj', bounty.bounty_id), escape_username(user.username),
+                              lambda names: f"Thanks for taking on `{name}`, {', '.join(names)}! "
+                                            f"You've each earned {pluralize(shares, 'share')}!")
 
-    add_log(user_id, user_id, 'otj', shares, bounty['bounty_id'])
-    return bot.reply_to(message,
-                        f"Thanks for taking on `{bounty['name']}`! You've earned {pluralize(shares, 'share')}!")
+    return reply_to(message,
+                    f"Thanks for taking on `{bounty.name}`! You've earned {pluralize(shares, 'share')}!")
 
 @bot.message_handler(commands=['abandon'])
-def abandon(message):
-    # get the args
-    args = str(message.text).split()
-    bounty_name = ' '.join(args[1:])  # Don't require quotes since it's a single argument
+@instrumented
+@chat_scoped
+@command(BOUNTY)
+def abandon(message, bounty):
     user_id = message.from_user.id
-    shares = get_setting('otj_shares')
+    shares = runtime()['settings'].otj_shares
 
-    if (user := runtime['users'].get(user_id)) is None:
-        return bot.reply_to(message, strings['unknown_user'])
+    if (user := sender(message)) is None:
+        return reply_to(message, strings['unknown_user'])
 
-    if bounty_id := parse_int(bounty_name):
-        if (bounty := runtime['bounties'].get(bounty_id, None)) is None:
-            return bot.reply_to(message, f"Bounty ID {bounty_id} does not exist!")
-    else:
-        if (bounty := find_bounty_by_name(bounty_name)) is None:
-            return bot.reply_to(message, f"There is no open bounty named `{bounty_name}`!")
+    if not bounty.is_active:
+        return reply_to(message, 'This bounty has ended!')
 
-    if not bounty['is_active']:
-        return bot.reply_to(message, 'This bounty has ended!')
+    # The scheduler closes it any moment now
+    if bounty.endtime <= now():
+        return reply_to(message, 'This bounty has ended!')
 
-    # If we get this far, the bounty is still active and we'll disable it
-    if bounty['endtime'] < now():
-        remove_bounty(bounty)
-        return bot.reply_to(message, 'This bounty has ended!')
+    bounty_participation = runtime()['participation'][bounty.bounty_id]
+    with state_lock:
+        if user_id not in bounty_participation:
+            error = strings['not_participating']
+        else:
+            error = None
+            del bounty_participation[user_id]
 
-    bounty_participation = runtime['participation'][bounty['bounty_id']]
-    if user_id not in bounty_participation:
-        return bot.reply_to(message, strings['not_participating'])
+    if error:
+        return reply_to(message, error)
 
-    c = db.cursor()
-    sqlite_insert_with_param = "DELETE FROM participation WHERE telegram_id = ? AND bounty_id = ?"
-    data_tuple = (user_id, bounty['bounty_id'])
     try:
-        c.execute(sqlite_insert_with_param, data_tuple)
-    except sqlite3.IntegrityError as e:
-        print('abandon', e)
-        return
+        persist(("DELETE FROM participation WHERE telegram_id = ? AND bounty_id = ?", (user_id, bounty.bounty_id)),
+                share_change(user_id, -shares),
+                log_entry(user_id, user_id, 'aban', -shares, bounty.bounty_id))
     except sqlite3.Error as e:
-        print('abandon general', e)
+        logger.error('abandon', exc_info=e)
+        with state_lock:
+            bounty_participation[user_id] = None
         return
 
-    sqlite_insert_with_param = "UPDATE users SET shares = shares - ? WHERE telegram_id = ?;"
-    data_tuple = (shares, user_id)
-    try:
-        c.execute(sqlite_insert_with_param, data_tuple)
-    except sqlite3.Error as e:
-        print(e)
-        return
+    adjust_shares(user, -shares)
 
-    db.commit()
-    user['shares'] -= shares
-    bounty_participation.remove(user_id)
+    return reply_to(message, f"A real G knows when they're in over their head. "
+                             f"You've left the bounty `{bounty.name}` and the shares have been removed.")
 
-    add_log(user_id, user_id, 'aban', -shares, bounty['bounty_id'])
-    return bot.reply_to(message, f"A real G knows when they're in over their head. "
-                                 f"You've left the bounty `{bounty['name']}` and the shares have been removed.")
+@on_setting_change('allocation')
+def allocation_changed(old, new):
+    with state_lock:
+        runtime()['leaderboard']['cache'].clear()  # The allocation is part of the header
 
-@bot.message_handler(commands=['leaderboard'])
-def leaderboard(message):
-    if not len(runtime['users']):
-        return bot.reply_to(message, 'There are currently no registered users!')
+def render_leaderboard(start, count):
+    board = runtime()['leaderboard']
+    users = [runtime()['users'][user_id] for _, user_id in board['ranking'][start:start + count]]
+    totalshares = board['total']
 
-    maxlength = len(max(runtime['users'].values(), key=lambda x: len(x['username']))['username'])
-    totalshares = sum((map(lambda x: x['shares'], runtime['users'].values())))
-    users = sorted(runtime['users'].values(), key=lambda item: item['shares'], reverse=True)
+    maxlength = max(len('User'), *(len(user.username) for user in users))
 
     user_list = f"{'User'.ljust(maxlength)} | Joined | Shares (%)\n"
     user_list += "=" * (len(user_list)-1) + "\n"
     for user in users:
-        user_list += f"{user['username'].ljust(maxlength)} | " \
-                     f"{datetime.datetime.fromtimestamp(user['created_at']).strftime('%b %d')} | " \
-                     f"{user['shares']} ({round(user['shares'] / totalshares * 100, 2)}%)\n"
+        percent = round(user.shares / totalshares * 100, 2) if totalshares else 0
+        user_list += f"{user.username.ljust(maxlength)} | " \
+                     f"{datetime.datetime.fromtimestamp(user.created_at).strftime('%b %d')} | " \
+                     f"{user.shares} ({percent}%)\n"
 
-    response = f"""
+    return f"""
 *Reward Allocation*: {creds_invested()}
 *Total Shares*: {totalshares}
 
@@ -508,15 +1271,41 @@ def leaderboard(message):
 ```
 """
 
-    bot.send_message(message.chat.id, response)
+@bot.message_handler(commands=['leaderboard'])
+@instrumented
+@chat_scoped
+@command(REST)
+def leaderboard(message, args):
+    if not len(runtime()['users']):
+        return reply_to(message, 'There are currently no registered users!')
+
+    # `/leaderboard`, `/leaderboard {page}` or `/leaderboard top {n}`
+    pages = -(-len(runtime()['users']) // leaderboard_page_size)
+
+    if len(args) == 2 and args[0] == 'top':
+        if not (count := parse_int(args[1])) or not 0 < count <= 100:
+            return reply_to(message, 'Pick a number between 1 and 100!')
+        key, start, footer = ('top', count), 0, ''
+    else:
+        if (page := parse_int(indexof(args, 0) or '1')) is None or not 0 < page <= pages:
+            return reply_to(message, f"There {'is' if pages == 1 else 'are'} only {pluralize(pages, 'page')}!")
+        key, start, count = ('page', page), (page - 1) * leaderboard_page_size, leaderboard_page_size
+        footer = ''
+        if pages > 1:
+            footer = f"Page {page}/{pages}" + (f", `/leaderboard {page + 1}` for more" if page < pages else '')
 
-@bot.message_handler(commands=['bump'])
-@num_arguments(1)
-def bump(message: telebot.types.Message):
-    target_user = user_from_mention(message)
+    with state_lock:
+        if (response := runtime()['leaderboard']['cache'].get(key)) is None:
+            response = render_leaderboard(start, count) + footer
+            runtime()['leaderboard']['cache'][key] = response
+
+    send_message(message.chat.id, response)
 
-    if target_user is None:
-        return bot.reply_to(message, strings['unknown_target'])
+@bot.message_handler(commands=['bump'])
+@instrumented
+@chat_scoped
+@command(MENTION)
+def bump(message: telebot.types.Message, target_user):
 
     """
     username_receiver = bot.get_chat_member(-445263888,username_receiver).user.id
@@ -525,46 +1314,43 @@ def bump(message: telebot.types.Message):
     print("id_user_receiver from db",username_receiver)
     """
 
-    if target_user['telegram_id'] == message.from_user.id:
-        return bot.reply_to(message, strings['self_bump'])
+    if target_user.telegram_id == message.from_user.id:
+        return reply_to(message, strings['self_bump'])
 
-    shares = get_setting('bump_shares')
+    shares = runtime()['settings'].bump_shares
 
-    c = db.cursor()
-    sqlite_insert_with_param = "UPDATE users SET shares = shares + ? WHERE telegram_id = ?;"
-    data_tuple = (shares, target_user['telegram_id'])
     try:
-        c.execute(sqlite_insert_with_param, data_tuple)
+        persist(share_change(target_user.telegram_id, shares),
+                log_entry(message.from_user.id, target_user.telegram_id, 'bump', shares))
     except sqlite3.IntegrityError as e:
-        print('bump integrity', e)
+        logger.error('bump integrity', exc_info=e)
         return
     except sqlite3.Error as e:
-        print('bump general', e)
-        return bot.reply_to(message, strings['general_error'])
-
-    db.commit()
+        logger.error('bump general', exc_info=e)
+        return reply_to(message, strings['general_error'])
 
-    target_user['shares'] += shares
-    add_log(message.from_user.id, target_user['telegram_id'], 'bump', shares)
+    adjust_shares(target_user, shares)
 
-    response = f"{escape_username(parse_user(message.from_user))} 🤜💥🤛 {escape_username(target_user['username'])}!\n" \
+    response = f"{escape_username(parse_user(message.from_user))} 🤜💥🤛 {escape_username(target_user.username)}!\n" \
                f"{pluralize(shares, 'share')} added!"
-    bot.send_message(message.chat.id, response)
+    send_message(message.chat.id, response)
 
 @bot.message_handler(commands=['bountylist'])
+@instrumented
+@chat_scoped
 def bountylist(message):
-    bounties = {key: val for key, val in runtime['bounties'].items() if val['is_active'] and val['endtime'] > now()}
+    bounties = sorted(runtime()['active_bounties'].values(), key=lambda x: x.bounty_id)
 
     if not len(bounties):
-        return bot.reply_to(message, "There are no active bounties at this time.")
+        return reply_to(message, "There are no active bounties at this time.")
 
     bounty_list = "ID: Name" + " ↳ Space | Time left\n".rjust(23)
-    for bounty_id, bounty in bounties.items():
-        space_left = bounty['worth'] - len(runtime['participation'][bounty['bounty_id']])
-        availability = f"{space_left}/{bounty['worth']}" if space_left else "Full!"
+    for bounty in bounties:
+        space_left = bounty.worth - len(runtime()['participation'][bounty.bounty_id])
+        availability = f"{space_left}/{bounty.worth}" if space_left else "Full!"
 
-        bounty_list += f"{bounty['bounty_id']}: {bounty['name']} \n"
-        bounty_list += f"{availability} | {display_time(bounty['endtime'] - now())}".rjust(31) + "\n"
+        bounty_list += f"{bounty.bounty_id}: {bounty.name} \n"
+        bounty_list += f"{availability} | {display_time(bounty.endtime - now())}".rjust(31) + "\n"
 
     response = f"""
 *Active bounties*
@@ -574,41 +1360,56 @@ def bountylist(message):
 ```
 Join a bounty using `/onthejob [ID]`
 """
-    bot.send_message(message.chat.id, response)
+    send_message(message.chat.id, response)
 
 @bot.message_handler(commands=['config'])
+@instrumented
+@chat_scoped
 @admin_command
-def config(message):
-    args = shlex.split(fix_quotes(message.text))
+@command(REST)
+def config(message, args):
+    args = [None] + args  # Keep positions lined up with the command text
 
     if len(args) < 2:
-        return bot.reply_to(message, "Use `get <key>`, `set <key> <val>`, or `show`")
+        return reply_to(message, "Use `get <key>`, `set <key> <val>`, or `show`")
 
     if args[1] == 'get':
-        value = runtime['settings'].get(indexof(args, 2), u"¯\\\_(ツ)\_/¯")
-        return bot.reply_to(message, f"`{escape_username(value)}")
+        value = show_setting(runtime()['settings'], key) if (key := indexof(args, 2)) in setting_types else u"¯\\\_(ツ)\_/¯"
+        return reply_to(message, f"`{escape_username(str(value))}")
 
     if args[1] == 'set':
         if (key := indexof(args, 2)) is None or (val := indexof(args, 3)) is None:
-            return bot.reply_to(message, f"Please set a value for `{key}`!")
+            return reply_to(message, f"Please set a value for `{key}`!")
+
+        if key not in setting_types:
+            return reply_to(message, f"There's no `{key}` setting. Try one of: {', '.join(setting_types)}")
 
-        c = db.cursor()
-        query = 'INSERT INTO settings (setting_name, setting_value) VALUES (?,?) ' \
-                'ON CONFLICT(setting_name) DO UPDATE SET setting_value=excluded.setting_value'
-        data = (key, val)
         try:
-            c.execute(query, data)
-            db.commit()
+            value = parse_setting(key, val)
+        except ValueError as e:
+            return reply_to(message, f"`{key}` {e}!")
+
+        query = 'INSERT INTO settings (chat_id, setting_name, setting_value) VALUES (?,?,?) ' \
+                'ON CONFLICT(chat_id, setting_name) DO UPDATE SET setting_value=excluded.setting_value'
+        data = (message.chat.id, key, val)
+        try:
+            persist((query, data))
         except sqlite3.Error as e:
-            print('config error', e)
-            return bot.reply_to(message, f"There was an error applying the config for `{key}` :(")
+            logger.error('config error', exc_info=e)
+            return reply_to(message, f"There was an error applying the config for `{key}` :(")
 
-        runtime['settings'][key] = val
-        return bot.reply_to(message, f"Setting saved for `{key}`")
+        settings = runtime()['settings']
+        old = getattr(settings, key)
+        setattr(settings, key, value)
+        if value != old:
+            for watcher in setting_watchers[key]:
+                watcher(old, value)
+        return reply_to(message, f"Setting saved for `{key}`: {show_setting(settings, key)}")
 
     if args[1] == 'show':
-        maxlen_k = (len(max(runtime['settings'].keys(), key=lambda x: len(x))))
-        maxlen_v = (len(max(runtime['settings'].values(), key=lambda x: len(str(x)))))
+        shown = {name: show_setting(runtime()['settings'], name) for name in setting_types}
+        maxlen_k = max(len(name) for name in shown)
+        maxlen_v = max(len(value) for value in shown.values())
 
         if maxlen_v > 20:
             maxlen_v = 20
@@ -616,8 +1417,7 @@ def config(message):
         setting_list = f"{'Setting'.ljust(maxlen_k)} | {'Value'.ljust(maxlen_v)}\n"
         setting_list += "=" * (len(setting_list)-1) + "\n"
 
-        for k, v in runtime['settings'].items():
-            v = str(v)
+        for k, v in shown.items():
             setting_list += f"{k.ljust(maxlen_k)} | {v if len(v) <= 20 else v[:17] + '...'}\n"
 
         response = f"""
@@ -627,12 +1427,49 @@ def config(message):
 {setting_list.rstrip()}
 ```
         """
-        return bot.send_message(message.chat.id, response)
+        return send_message(message.chat.id, response)
+
+    reply_to(message, "Uh, your choices are `get`, `set`, or `show`. Don't get cute.")
+
+@bot.message_handler(commands=['stats'])
+@instrumented
+@chat_scoped
+@admin_command
+def stats(message):
+    with metrics_lock:
+        commands = sorted(((name, dict(entry)) for name, entry in metrics['commands'].items()),
+                          key=lambda x: -x[1]['seconds'])
+        statements = sorted(metrics['statements'].items(), key=lambda x: -x[1][1])[:5]
+
+    if not commands:
+        return reply_to(message, "Nothing recorded yet" + ("" if metrics_enabled else " (METRICS=0)"))
+
+    maxlen = max(len('Cmd'), *(len(name) for name, _ in commands))
+    table = f"{'Cmd'.ljust(maxlen)} |     N | Err |  Avg ms | Parse |    DB |  Send\n"
+    table += "=" * (len(table) - 1) + "\n"
+    for name, entry in commands:
+        avg = lambda key: entry[key] / max(entry['count'], 1) * 1000
+        table += f"{name.ljust(maxlen)} | {entry['count']:>5} | {entry['errors']:>3} | {avg('seconds'):>7.1f} | " \
+                 f"{avg('parse'):>5.1f} | {avg('db'):>5.1f} | {avg('send'):>5.1f}\n"
+
+    slowest = "\n".join(f"{seconds * 1000:>8.1f}ms x{count} {' '.join(query.split())[:40]}"
+                         for query, (count, seconds) in statements)
+
+    response = f"""
+*Command timings* (averages)
 
-    bot.reply_to(message, "Uh, your choices are `get`, `set`, or `show`. Don't get cute.")
+```
+{table.rstrip()}
+```
+*Slowest statements* (total time)
 
-def remove_bounty(bounty: dict):
-    c = db.cursor()
+```
+{slowest}
+```
+"""
+    reply_to(message, response)
+
+def remove_bounty(bounty: Bounty):
 
     # Not sure we need to actually remove participation; could be used as a log
     # Keeping updated code just in case
@@ -643,112 +1480,604 @@ def remove_bounty(bounty: dict):
     #     c.execute(sqlite_insert_with_param, data_tuple)
     # except sqlite3.Error as e:
     #     print(e)
-    #     return bot.reply_to(message, strings['general_error'])
+    #     return reply_to(message, strings['general_error'])
     # except ValueError as e:
     #     print(e)
-    #     return bot.reply_to(message, strings['general_error'])
+    #     return reply_to(message, strings['general_error'])
     # Update the participating users
-    sqlite_insert_with_param = "UPDATE bounties SET endtime = ? AND is_active = FALSE WHERE bounty_id = ?;"
-    data_tuple = (now(), bounty['bounty_id'],)
+    # A bounty that ran out (possibly while we were offline) keeps its scheduled end time
+    ended_at = min(now(), bounty.endtime)
+    settlement = 'pending' if bounty.pool else None
+
+    sqlite_insert_with_param = "UPDATE bounties SET endtime = ?, is_active = FALSE, settlement = ? WHERE bounty_id = ?;"
+    data_tuple = (ended_at, settlement, bounty.bounty_id,)
     try:
-        c.execute(sqlite_insert_with_param, data_tuple)
+        persist((sqlite_insert_with_param, data_tuple))
     except sqlite3.IntegrityError as e:
-        print('remove_bounty integrity', e)
+        logger.error('remove_bounty integrity', exc_info=e)
         raise Exception(e)
     except sqlite3.Error as e:
-        print('remove_bounty error', e)
+        logger.error('remove_bounty error', exc_info=e)
         raise Exception(e)
 
-    # save and code
-    db.commit()
+    bounty.is_active = False
+    bounty.endtime = ended_at
+    bounty.settlement = settlement
+    unindex_bounty(bounty)
 
-@bot.message_handler(commands=['grant'])
+    with state_lock:
+        runtime()['bounties'].pop(bounty.bounty_id, None)
+        remember_bounty(bounty, runtime()['participation'].pop(bounty.bounty_id, {}))
+
+    # A pool is left pending for the caller to settle_bounty() once it has told the chat the bounty ended
+
+def settle_bounty(bounty: Bounty):
+    """
+    Pay out an ended bounty's pool, split evenly among its muscle with the remainder going to whoever joined first.
+    Every credit, its log row and the bounty's move to 'paid' are one transaction, which starts by recording the
+    settlement under the bounty's ID: if it was already paid (say, resumed after a crash) that insert fails and
+    nothing else is applied. A failure leaves the bounty pending for resume_settlements() to try again.
+    """
+    muscle = [row['telegram_id'] for row in read_query(
+        'SELECT telegram_id FROM participation WHERE bounty_id = ? ORDER BY rowid', (bounty.bounty_id,))]
+    share, remainder = divmod(bounty.pool, len(muscle)) if muscle else (0, 0)
+    changes = [(telegram_id, share + (i < remainder)) for i, telegram_id in enumerate(muscle)]
+    changes = [(telegram_id, amount) for telegram_id, amount in changes if amount]
+
+    chat_id, at = runtime()['chat_id'], now()
+    try:
+        persist(("INSERT INTO settlements (bounty_id, pool, participants, settled_at) VALUES (?, ?, ?, ?)",
+                 (bounty.bounty_id, bounty.pool, len(muscle), at)),
+                share_changes(changes),
+                ("INSERT INTO log (chat_id, from_id, to_id, action, subject, amount, at) VALUES (?,?,?,?,?,?,?)",
+                 [(chat_id, telegram_id, telegram_id, 'paid', bounty.bounty_id, amount, at)
+                  for telegram_id, amount in changes], MANY),
+                ("UPDATE bounties SET settlement = 'paid' WHERE bounty_id = ?", (bounty.bounty_id,)))
+    except sqlite3.IntegrityError:
+        bounty.settlement = 'paid'  # Someone got there first
+        return
+    except sqlite3.Error as e:
+        logger.error('settlement', exc_info=e, extra={'fields': {'bounty_id': bounty.bounty_id}})
+        return
+
+    bounty.settlement = 'paid'
+    for telegram_id, amount in changes:
+        if (user := runtime()['users'].get(telegram_id)) is not None:
+            adjust_shares(user, amount)
+
+    if not changes:
+        return send_message(chat_id, f"Nobody worked `{bounty.name}`, so its {pluralize(bounty.pool, 'share')} stay put.")
+
+    paid = [(runtime()['users'][telegram_id].username if telegram_id in runtime()['users'] else f"#{telegram_id}",
+             amount) for telegram_id, amount in changes[:bulk_summary_rows]]
+    send_message(chat_id, f"💰 `{bounty.name}` paid out {pluralize(bounty.pool, 'share')}: " +
+                 ', '.join(f"{escape_username(name)} +{amount}" for name, amount in paid) +
+                 (f" and {len(changes) - len(paid)} more" if len(changes) > len(paid) else ''))
+
+def resume_settlements():
+    # Bounties that ended but never got paid: the bot went down in between, or the payout failed
+    for row in read_query("SELECT * FROM bounties WHERE settlement = 'pending'"):
+        if not owns_chat(row['chat_id']):
+            continue
+
+        try:
+            with chat_scope(row['chat_id']):
+                # Pay out the copy /audit shows if there is one, or it would stay pending there
+                with state_lock:
+                    entry = runtime()['bounty_history'].get(row['bounty_id'])
+                settle_bounty(entry[0] if entry else Bounty.from_row(row))
+        except Exception as e:
+            logger.error('settlement', exc_info=e, extra={'fields': {'bounty_id': row['bounty_id']}})
+
+def close_bounty(bounty: Bounty, announce=True):
+    remove_bounty(bounty)
+
+    if bounty.chat_id and announce:
+        participation_list = muscle_list(bounty.bounty_id)
+        response = f"""
+*BOUNTY CLOSED*
+
+ID {bounty.bounty_id}: `{bounty.name}` ran for {display_time(bounty.endtime - bounty.created_at)}.
+Muscle ({len(participation_list)}/{bounty.worth}): {', '.join(participation_list) or 'nobody showed up'}
+"""
+        send_message(bounty.chat_id, response)
+
+    if bounty.settlement == 'pending':
+        settle_bounty(bounty)
+
+def schedule_expiry(bounty: Bounty):
+    with expiry_cv:
+        heapq.heappush(expiry_heap, (bounty.endtime, bounty.chat_id, bounty.bounty_id))
+        expiry_cv.notify()
+
+def expiry_loop():
+    while True:
+        with expiry_cv:
+            while scheduler is not None and (not expiry_heap or expiry_heap[0][0] > time.time()):
+                expiry_cv.wait(timeout=expiry_heap[0][0] - time.time() if expiry_heap else None)
+
+            if scheduler is None:
+                return
+
+            endtime, chat_id, bounty_id = heapq.heappop(expiry_heap)
+
+        try:
+            with chat_scope(chat_id):
+                # Ended by hand in the meantime
+                if (bounty := runtime()['bounties'].get(bounty_id)) is None or not bounty.is_active \
+                        or bounty.endtime != endtime:
+                    continue
+
+                close_bounty(bounty, announce=endtime >= expiry_since)
+        except Exception as e:
+            logger.error('expiry', exc_info=e)
+
+def start_scheduler():
+    global scheduler
+
+    scheduler = threading.Thread(target=expiry_loop, name='bounty-expiry', daemon=True)
+    scheduler.start()
+
+def stop_scheduler():
+    global scheduler
+
+    if scheduler is None:
+        return
+
+    thread, scheduler = scheduler, None
+    with expiry_cv:
+        expiry_cv.notify()
+    thread.join()
+
+def snapshot_balances():
+    """
+    Fold log rows newer than the snapshots into them, a chunk per transaction so commands keep flowing in between.
+    Each chunk starts from whatever the snapshots have reached by then, so running this twice can't count a row twice.
+    """
+    last = read_query('SELECT MAX(rowid) AS last FROM log')[0]['last'] or 0
+    done = read_query('SELECT MAX(through_rowid) AS done FROM balance_snapshots')[0]['done'] or 0
+
+    query = 'INSERT INTO balance_snapshots (chat_id, telegram_id, shares, through_rowid) ' \
+            'SELECT chat_id, to_id, SUM(amount), :hi FROM log ' \
+            'WHERE rowid > (SELECT COALESCE(MAX(through_rowid), 0) FROM balance_snapshots) AND rowid <= :hi ' \
+            'GROUP BY chat_id, to_id ' \
+            'ON CONFLICT (chat_id, telegram_id) DO UPDATE SET shares = shares + excluded.shares, ' \
+            'through_rowid = excluded.through_rowid'
+    for hi in range(done + snapshot_chunk_size, last + snapshot_chunk_size, snapshot_chunk_size):
+        persist((query, {'hi': min(hi, last)}))
+
+def balance_drift(chat_id):
+    # Yields (telegram_id, shares, shares according to the log) for every user in the chat, a chunk at a time
+    query = 'SELECT u.telegram_id, u.shares, COALESCE(s.shares, 0) + COALESCE((' \
+            'SELECT SUM(amount) FROM log WHERE log.chat_id = u.chat_id AND log.to_id = u.telegram_id ' \
+            'AND log.rowid > COALESCE(s.through_rowid, 0)), 0) AS expected ' \
+            'FROM users u LEFT JOIN balance_snapshots s ON s.chat_id = u.chat_id AND s.telegram_id = u.telegram_id ' \
+            'WHERE u.chat_id = ? AND u.telegram_id > ? ORDER BY u.telegram_id LIMIT ?'
+
+    after = -sys.maxsize
+    while rows := read_query(query, (chat_id, after, reconcile_chunk_size)):
+        yield from ((row['telegram_id'], row['shares'], row['expected']) for row in rows)
+        after = rows[-1]['telegram_id']
+
+@bot.message_handler(commands=['reconcile'])
+@instrumented
+@chat_scoped
 @admin_command
-@num_arguments(2)
-def grant(message):
-    target_user = user_from_mention(message)
-    args = str(message.text).split()
+def reconcile(message):
+    checked = 0
+    fixed = []
+
+    for telegram_id, shares, expected in balance_drift(message.chat.id):
+        checked += 1
+        user = runtime()['users'].get(telegram_id)
+        if user is None or user.shares != shares:
+            # Memory is off from the database too (or a change is in flight); start over from the database
+            runtime()['stale'] = True
+
+        if shares == expected:
+            continue
+
+        # Both sides were read in one statement, so the difference still holds if shares moved since
+        delta = expected - shares
+        try:
+            persist(share_change(telegram_id, delta))
+        except sqlite3.Error as e:
+            logger.error('reconcile', exc_info=e)
+            return reply_to(message, strings['general_error'])
+
+        runtime()['stale'] = True
+        fixed.append((user.username if user else str(telegram_id), delta))
 
-    if target_user is None:
-        return bot.reply_to(message, strings['unknown_target'])
+    if not fixed:
+        return reply_to(message, f"Checked {pluralize(checked, 'balance')} against the log. All good!")
 
-    if target_user['telegram_id'] == message.from_user.id:
-        return bot.reply_to(message, strings['self_grant'])
+    details = ', '.join(f"{escape_username(name)} {delta:+}" for name, delta in fixed[:10]) + \
+        (f" and {len(fixed) - 10} more" if len(fixed) > 10 else '')
+    reply_to(message, f"Checked {pluralize(checked, 'balance')} against the log and fixed {len(fixed)}: {details}")
 
-    if not (shares := parse_int(args[-1])) or shares < 0:
-        return bot.reply_to(message, 'Grant a positive number of shares!')
+@bot.message_handler(commands=['role'])
+@instrumented
+@chat_scoped
+@admin_command
+@command(TEXT, TEXT, MENTION)
+def role(message, action, role_name, target_user):
+    if action not in ('add', 'remove') or role_name not in roles:
+        return reply_to(message, f"Use `/role add|remove {{{'|'.join(roles)}}} {{@User}}`")
+
+    members = runtime()['roles'][role_name]
+    if action == 'remove' and role_name == 'admin' and target_user.telegram_id == message.from_user.id:
+        return reply_to(message, "Get another admin to take your admin role away.")
+
+    if action == 'add':
+        query = 'INSERT OR IGNORE INTO roles (chat_id, telegram_id, role, granted_at) VALUES (?, ?, ?, ?)'
+        data = (message.chat.id, target_user.telegram_id, role_name, now())
+    else:
+        query = 'DELETE FROM roles WHERE chat_id = ? AND telegram_id = ? AND role = ?'
+        data = (message.chat.id, target_user.telegram_id, role_name)
 
-    c = db.cursor()
-    sqlite_insert_with_param = "UPDATE users SET shares = shares + ? WHERE telegram_id = ?;"
-    data_tuple = (shares, target_user['telegram_id'])
     try:
-        c.execute(sqlite_insert_with_param, data_tuple)
+        persist((query, data))
     except sqlite3.Error as e:
-        print('grant', e)
-        return bot.reply_to(message, strings['general_error'])
+        logger.error('role', exc_info=e)
+        return reply_to(message, strings['general_error'])
 
-    db.commit()
+    if action == 'add':
+        members.add(target_user.telegram_id)
+    else:
+        members.discard(target_user.telegram_id)
+    if role_name == 'dev':
+        with state_lock:
+            dev_recipients[message.chat.id] = set(members)
 
-    target_user['shares'] += shares
-    add_log(message.from_user.id, target_user['telegram_id'], 'grnt', shares)
+    reply_to(message, f"{escape_username(target_user.username)} " +
+             (f"is now {role_name}." if action == 'add' else f"is no longer {role_name}."))
 
-    response = f"{escape_username(target_user['username'])} received {pluralize(shares, 'share')} from {escape_username(parse_user(message.from_user))} 🤑"
-    bot.send_message(message.chat.id, response)
+@bot.message_handler(commands=['roles'])
+@instrumented
+@chat_scoped
+@admin_command
+def list_roles(message):
+    lines = []
+    for role_name in roles:
+        names = sorted(user.username if (user := runtime()['users'].get(telegram_id)) else f"#{telegram_id}"
+                       for telegram_id in runtime()['roles'][role_name])
+        lines.append(f"*{role_name}*: " + (escape_username(', '.join(names)) if names else 'nobody'))
 
-@bot.message_handler(commands=['cashout'])
+    if owner_ids:
+        lines.append(f"Bot owners ({len(owner_ids)}) are admin and dev everywhere.")
+    if chat_admin_sync:
+        lines.append("Telegram group admins are admins here too.")
+
+    reply_to(message, '\n'.join(lines))
+
+def archive_log():
+    """
+    Move old log rows out to the archive a segment at a time: the rows go to a gzipped JSONL file first, then one
+    transaction indexes the segment and deletes them. Only rows already counted in balance_snapshots go, so
+    /reconcile never needs them back; log_daily counted them as they were written, so it keeps them too.
+    """
+    cutoff = now() - int(log_retention_days * 86400)
+    os.makedirs(archive_root, exist_ok=True)
+
+    while not maintenance_stop.is_set():
+        # The newest row always stays: log has no AUTOINCREMENT, so emptying it would let SQLite hand out rowids
+        # again from 1, below through_rowid (never counted in a balance) and clashing with segment names
+        rows = read_query("SELECT rowid, * FROM log WHERE at < ? AND "
+                          "rowid <= (SELECT COALESCE(MAX(through_rowid), 0) FROM balance_snapshots) AND "
+                          "rowid < (SELECT MAX(rowid) FROM log) "
+                          "ORDER BY rowid LIMIT ?", (cutoff, archive_batch_size))
+        if not rows:
+            return
+
+        first, last = rows[0]['rowid'], rows[-1]['rowid']
+        path = f"log-{first:012d}-{last:012d}.jsonl.gz"
+        target = os.path.join(archive_root, path)
+        with gzip.open(target + '.tmp', 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(dict(row)) + '\n')
+        with open(target + '.tmp', 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(target + '.tmp', target)
+
+        # The same rows as above: nothing new can land inside [first, last]
+        batch = {'first': first, 'last': last, 'cutoff': cutoff}
+        where = 'rowid >= :first AND rowid <= :last AND at < :cutoff'
+        persist(("INSERT INTO log_segments (path, first_rowid, last_rowid, entries, created_at) "
+                 "VALUES (:path, :first, :last, :entries, :created_at)",
+                 dict(batch, path=path, entries=len(rows), created_at=now())),
+                ("INSERT INTO log_segment_users (chat_id, telegram_id, segment_id, entries) "
+                 "SELECT chat_id, to_id, (SELECT MAX(segment_id) FROM log_segments), COUNT(*) FROM log "
+                 f"WHERE {where} GROUP BY chat_id, to_id", batch),
+                (f"DELETE FROM log WHERE {where}", batch))
+
+        maintenance_stop.wait(archive_pause)
+
+def maintenance_loop():
+    while not maintenance_stop.wait(snapshot_interval):
+        try:
+            resume_settlements()
+            snapshot_balances()
+            archive_log()
+        except Exception as e:
+            logger.error('maintenance', exc_info=e)
+
+def start_maintenance():
+    global maintenance
+
+    maintenance_stop.clear()
+    maintenance = threading.Thread(target=maintenance_loop, name='maintenance', daemon=True)
+    maintenance.start()
+
+def stop_maintenance():
+    global maintenance
+
+    if maintenance is None:
+        return
+
+    thread, maintenance = maintenance, None
+    maintenance_stop.set()
+    thread.join()
+
+@bot.message_handler(commands=['grant'])
+@instrumented
+@chat_scoped
 @admin_command
-@num_arguments(2)
-def cashout(message):
-    target_user = user_from_mention(message)
-    args = str(message.text).split()
+@command((AMOUNTS, 'Grant a positive number of shares!'))
+def grant(message, amounts):
+    apply_amounts(message, 'grnt', amounts)
 
-    if target_user is None:
-        return bot.reply_to(message, strings['unknown_target'])
+@bot.message_handler(commands=['cashout'])
+@instrumented
+@chat_scoped
+@admin_command
+@command((AMOUNTS, 'Cash out a positive number of shares!'))
+def cashout(message, amounts):
+    apply_amounts(message, '$out', amounts)
+
+def bulk_action(message):
+    # The command in a document's caption, for the CSV form of /grant and /cashout
+    command_name = (message.caption or '').split(maxsplit=1)[0:1]
+    return {'/grant': 'grnt', '/cashout': '$out'}.get(command_name[0].split('@')[0] if command_name else None)
+
+@bot.message_handler(content_types=['document'], func=lambda message: bulk_action(message) is not None)
+@instrumented
+@chat_scoped
+@admin_command
+def bulk_upload(message):
+    """
+    /grant or /cashout as the caption of a CSV with one `user,shares` line per payout; users by @name or ID.
+    The whole file is checked before anything is applied, and then it all goes in one transaction.
+    """
+    if message.document.file_size and message.document.file_size > bulk_max_bytes:
+        return reply_to(message, f"That file is too big! Keep it under {bulk_max_bytes // 1024} KB.")
 
-    if not (shares := parse_int(args[-1])) or shares < 0:
-        return bot.reply_to(message, 'Cash out a positive number of shares!')
+    try:
+        content = bot.download_file(bot.get_file(message.document.file_id).file_path)
+    except Exception as e:
+        logger.warning('bulk download', exc_info=e)
+        return reply_to(message, "I couldn't download that file. Try sending it again?")
 
-    if target_user['shares'] < shares:
-        return bot.reply_to(message, f"That bitch is too poor! Max cashout amount is {target_user['shares']}.")
+    try:
+        lines = list(csv.reader(content.decode('utf-8-sig').splitlines()))
+    except (UnicodeDecodeError, csv.Error):
+        return reply_to(message, "That doesn't look like a CSV file.")
+
+    entries = []
+    for number, row in enumerate(lines, 1):
+        if not row or not ''.join(row).strip():
+            continue
+        if number == 1 and parse_int(indexof(row, 1) or '') is None:
+            continue  # A header
+
+        ref, amount = (indexof(row, 0) or '').strip(), (indexof(row, 1) or '').strip()
+        user = runtime()['users'].get(parse_int(ref)) if ref.isdigit() else find_user_by_name(ref)
+        entries.append((f"Line {number} (`{ref}`)", user, amount))
+
+    if not entries:
+        return reply_to(message, "There's nothing in that file. Use one `user,shares` line per payout.")
+    if len(entries) > bulk_max_rows:
+        return reply_to(message, f"That's {len(entries)} lines; the most I'll take at once is {bulk_max_rows}.")
 
-    c = db.cursor()
-    sqlite_insert_with_param = "UPDATE users SET shares = shares - ? WHERE telegram_id = ?;"
-    data_tuple = (shares, target_user['telegram_id'])
     try:
-        c.execute(sqlite_insert_with_param, data_tuple)
+        amounts = collect_amounts(entries)
+    except ArgumentError as e:
+        return reply_to(message, str(e))
+
+    apply_amounts(message, bulk_action(message), amounts)
+
+def apply_amounts(message, action, amounts):
+    # amounts as from collect_amounts(); every change and its log row are written in one transaction, or none are
+    sign = 1 if action == 'grnt' else -1
+    single = len(amounts) == 1
+
+    if action == 'grnt' and message.from_user.id in amounts:
+        return reply_to(message, strings['self_grant'])
+
+    if action == '$out':
+        with state_lock:
+            short = [(user, user.shares) for user, shares in amounts.values() if user.shares < shares]
+            if not short:
+                # Take the shares out while the write is in flight so concurrent cashouts can't overdraw them
+                for user, shares in amounts.values():
+                    adjust_shares(user, -shares)
+
+        if short and single:
+            return reply_to(message, f"That bitch is too poor! Max cashout amount is {short[0][1]}.")
+        if short:
+            return reply_to(message, "Too poor to cash out that much, so nothing was changed: " +
+                            ', '.join(f"{escape_username(user.username)} (max {most})" for user, most in short[:10]) +
+                            (f" and {len(short) - 10} more" if len(short) > 10 else ''))
+
+    changes = [(telegram_id, sign * shares) for telegram_id, (_, shares) in amounts.items()]
+    try:
+        persist(share_changes(changes), log_entries(message.from_user.id, action, changes))
     except sqlite3.Error as e:
-        print('cashout', e)
-        return bot.reply_to(message, strings['general_error'])
+        logger.error('grant' if action == 'grnt' else 'cashout', exc_info=e)
+        if action == '$out':
+            for user, shares in amounts.values():
+                adjust_shares(user, shares)
+        return reply_to(message, strings['general_error'])
+
+    if action == 'grnt':
+        for user, shares in amounts.values():
+            adjust_shares(user, shares)
+
+    if single and action == 'grnt':
+        user, shares = next(iter(amounts.values()))
+        return send_message(message.chat.id, f"{escape_username(user.username)} received {pluralize(shares, 'share')} "
+                                             f"from {escape_username(parse_user(message.from_user))} 🤑")
+    if single:
+        user, shares = next(iter(amounts.values()))
+        return reply_to(message, f"{user.username} took the money and ran! 🤑\n"
+                                 f"{pluralize(shares, 'share')} redeemed, with {pluralize(user.shares, 'share')} left.")
+
+    send_message(message.chat.id, render_amounts(action, list(amounts.values())))
+
+def render_amounts(action, amounts):
+    shown = amounts[:bulk_summary_rows]
+    maxlength = max(len('User'), *(len(user.username) for user, _ in shown))
+    sign = '+' if action == 'grnt' else '-'
+
+    user_list = f"{'User'.ljust(maxlength)} | Shares | Balance\n"
+    user_list += "=" * (len(user_list)-1) + "\n"
+    for user, shares in shown:
+        user_list += f"{user.username.ljust(maxlength)} | {(sign + str(shares)).ljust(6)} | {user.shares}\n"
+    if len(amounts) > len(shown):
+        user_list += f"...and {len(amounts) - len(shown)} more\n"
 
-    db.commit()
+    return f"""
+*{'Granted' if action == 'grnt' else 'Cashed out'}*: {pluralize(sum(shares for _, shares in amounts), 'share')} \
+{'to' if action == 'grnt' else 'for'} {pluralize(len(amounts), 'user')}
 
-    add_log(message.from_user.id, target_user['telegram_id'], '$out', -shares)
+```
+{user_list}
+```
+"""
+
+def log_entry(from_id, to_id, action, value, subject=''):
+    # Statement for persist(), so the log row lands in the same transaction as the change it describes
+    return "INSERT INTO log (chat_id, from_id, to_id, action, subject, amount, at) VALUES (?,?,?,?,?,?,?)", \
+        (runtime()['chat_id'], from_id, to_id, action, subject, value, now())
 
-    target_user['shares'] -= shares
-    response = f"{target_user['username']} took the money and ran! 🤑\n" \
-               f"{pluralize(shares, 'share')} redeemed, with {pluralize(target_user['shares'], 'share')} left."
-    bot.reply_to(message, response)
+def share_change(telegram_id, amount):
+    return "UPDATE users SET shares = shares + ? WHERE chat_id = ? AND telegram_id = ?;", \
+        (amount, runtime()['chat_id'], telegram_id)
+
+def log_entries(from_id, action, changes):
+    # One executemany statement for [(to_id, amount)]
+    chat_id, at = runtime()['chat_id'], now()
+    return "INSERT INTO log (chat_id, from_id, to_id, action, subject, amount, at) VALUES (?,?,?,?,?,?,?)", \
+        [(chat_id, from_id, to_id, action, '', amount, at) for to_id, amount in changes], MANY
+
+def share_changes(changes):
+    # One executemany statement for [(telegram_id, amount)]
+    return "UPDATE users SET shares = shares + ? WHERE chat_id = ? AND telegram_id = ?;", \
+        [(amount, runtime()['chat_id'], telegram_id) for telegram_id, amount in changes], MANY
 
 def add_log(from_id, to_id, action, value, subject=''):
-    c = db.cursor()
-    log_query = "INSERT INTO log VALUES (?,?,?,?,?,?)"
-    data = (from_id, to_id, action, subject, value, now())
     try:
-        c.execute(log_query, data)
+        persist(log_entry(from_id, to_id, action, value, subject))
+    except sqlite3.Error as e:
+        # The devs hear about it through AlertHandler, without holding up this command
+        logger.error('logging error', exc_info=e)
+
+@timed('db')
+def persist(*statements):
+    """
+    Queue (query, params) statements to be applied in a single transaction by the writer thread; a statement given
+    as (query, [params, ...], MANY) runs once per params through executemany.
+    Blocks until the transaction is committed (or failed), so callers only acknowledge durable changes.
+    Returns the lastrowid of the first statement; raises the sqlite3.Error that aborted the statements.
+    """
+    job = {'statements': statements, 'done': threading.Event(), 'result': None, 'error': None}
+    write_queue.put(job)
+    job['done'].wait()
+
+    if job['error'] is not None:
+        raise job['error']
+
+    return job['result']
+
+def apply_job(conn: sqlite3.Connection, job):
+    # Each job gets its own savepoint so one failing command doesn't take the rest of the batch with it
+    conn.execute('SAVEPOINT job')
+    try:
+        for i, (query, params, *mode) in enumerate(job['statements']):
+            started = time.perf_counter()
+            cursor = conn.executemany(query, params) if mode == [MANY] else conn.execute(query, params)
+            record_statement(query, time.perf_counter() - started)
+            if i == 0:
+                job['result'] = cursor.lastrowid
+        conn.execute('RELEASE job')
     except sqlite3.Error as e:
-        print('logging error', e)
-        for username in dev_usernames:
-            if cur_user := find_user_by_name(username):
-                bot.send_message(cur_user['telegram_id'], 'Just so you know, I had an issue with logging...')
-                bot.send_message(cur_user['telegram_id'], e)
+        conn.execute('ROLLBACK TO job')
+        conn.execute('RELEASE job')
+        job['error'] = e
+
+@timed('db')
+def read_query(query, params=()):
+    # Borrow a read-only connection; WAL lets these run alongside the writer without blocking it
+    conn = read_pool.get()
+    started = time.perf_counter()
+    try:
+        return conn.execute(query, params).fetchall()
+    finally:
+        read_pool.put(conn)
+        record_statement(query, time.perf_counter() - started)
+
+def writer_loop(path):
+    # Webhook workers each have a writer on the same file; wait a while for the others' commits
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    conn.execute('PRAGMA synchronous = FULL')  # NORMAL in WAL mode can lose the last commits on power loss
+    running = True
+
+    while running:
+        if (job := write_queue.get()) is None:
+            break
+
+        # Group commit: when others are already queued behind this job, whatever shows up within the window shares
+        # the transaction's fsync. A lone write has nothing to wait for and commits straight away.
+        batch = [job]
+        deadline = time.monotonic() + commit_window if not write_queue.empty() else 0
+        while len(batch) < commit_batch_size:
+            try:
+                if (remaining := deadline - time.monotonic()) > 0:
+                    job = write_queue.get(timeout=remaining)
+                else:
+                    job = write_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if job is None:
+                running = False
+                break
+
+            batch.append(job)
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in batch:
+                apply_job(conn, job)
+            started = time.perf_counter()
+            conn.execute('COMMIT')
+            record_statement('COMMIT', time.perf_counter() - started)
+        except sqlite3.Error as e:
+            logger.error('writer commit error', exc_info=e)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for job in batch:
+                job['error'] = job['error'] or e
+
+        for job in batch:
+            job['done'].set()
 
-    db.commit()
+    conn.close()
 
 def creds_invested():
-    return get_setting('allocation')
+    return runtime()['settings'].allocation
 
-def setup():
-    db.cursor().execute('''
+def migration_base_schema(db: sqlite3.Connection):
+    db.execute('''
         CREATE TABLE IF NOT EXISTS bounties (
             bounty_id INTEGER PRIMARY KEY AUTOINCREMENT,
             name VARCHAR(50) NOT NULL,	
@@ -759,7 +2088,7 @@ def setup():
         );
     ''')
 
-    db.cursor().execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS users (
             telegram_id INTEGER PRIMARY KEY NOT NULL,
             username VARCHAR(50) NOT NULL,
@@ -769,7 +2098,7 @@ def setup():
         ); 
     ''')
 
-    db.cursor().execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS participation (
             telegram_id INTEGER NOT NULL,
             bounty_id INTEGER NOT NULL,
@@ -778,7 +2107,7 @@ def setup():
         );
     ''')
 
-    db.cursor().execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS log (
             from_id INTEGER NOT NULL,
             to_id INTEGER NOT NULL,
@@ -788,7 +2117,7 @@ def setup():
             at DATE NOT NULL
         );
     ''')
-    db.cursor().execute('''
+    db.execute('''
         CREATE TABLE IF NOT EXISTS settings (
             setting_id INTEGER PRIMARY KEY AUTOINCREMENT,
             setting_name VARCHAR(50) UNIQUE NOT NULL,
@@ -796,35 +2125,1039 @@ def setup():
         )
     ''')
 
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM bounties")
-    for row in cursor.fetchall():
-        runtime['bounties'][row['bounty_id']] = dict(row)
+def migration_bounty_chat(db: sqlite3.Connection):
+    # Databases that already went through the ad-hoc ALTER in setup() have the column
+    if 'chat_id' not in columns(db, 'bounties'):
+        db.execute('ALTER TABLE bounties ADD COLUMN chat_id INTEGER')
+
+def migration_indexes(db: sqlite3.Connection):
+    db.execute('CREATE INDEX IF NOT EXISTS log_to_at ON log(to_id, at DESC)')
+    db.execute('CREATE INDEX IF NOT EXISTS bounties_active_endtime ON bounties(is_active, endtime)')
+
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'participation_bounty_user'").fetchone():
+        return
+
+    # Duplicate joins have to go before the unique index can exist
+    db.execute('CREATE INDEX IF NOT EXISTS participation_dedupe ON participation(bounty_id, telegram_id)')
+    in_chunks(db, 'participation', 'DELETE FROM participation WHERE rowid >= :lo AND rowid < :hi AND EXISTS '
+                                   '(SELECT 1 FROM participation p WHERE p.bounty_id = participation.bounty_id '
+                                   'AND p.telegram_id = participation.telegram_id AND p.rowid < participation.rowid)')
+    db.execute('DROP INDEX participation_dedupe')
+    db.execute('CREATE UNIQUE INDEX participation_bounty_user ON participation(bounty_id, telegram_id)')
+
+def migration_repair_ended_bounties(db: sqlite3.Connection):
+    # remove_bounty used to run "SET endtime = ? AND is_active = FALSE", which stored 0 in endtime and left the
+    # bounty active. The real end time is gone; created_at is the closest thing we have.
+    in_chunks(db, 'bounties', 'UPDATE bounties SET endtime = created_at, is_active = FALSE '
+                              'WHERE rowid >= :lo AND rowid < :hi AND endtime = 0')
+
+def migration_close_timed_out_bounties(db: sqlite3.Connection):
+    # The old bot never closed a bounty when its time ran out, so every one it let lapse is still active. Close them
+    # here rather than have the scheduler post a *BOUNTY CLOSED* for each. None of them has a pool to pay out.
+    in_chunks(db, 'bounties', "UPDATE bounties SET is_active = FALSE WHERE rowid >= :lo AND rowid < :hi "
+                              "AND is_active = TRUE AND pool = 0 AND endtime < :now", {'now': now()})
+
+def migration_partition_by_chat(db: sqlite3.Connection):
+    # Users, settings and the log get a chat_id like bounties have; everything already here belongs to one group
+    owner = owner_chat(db)
+
+    in_chunks(db, 'bounties', 'UPDATE bounties SET chat_id = :chat '
+                              'WHERE rowid >= :lo AND rowid < :hi AND chat_id IS NULL', {'chat': owner})
+    db.execute('CREATE INDEX IF NOT EXISTS bounties_chat_active ON bounties(chat_id, is_active)')
+
+    if 'chat_id' not in columns(db, 'users'):
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS users_by_chat (
+                chat_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                username VARCHAR(50) NOT NULL,
+                shares INTEGER NOT NULL,
+                is_admin BOOLEAN DEFAULT FALSE,
+                created_at DATE NOT NULL,
+                PRIMARY KEY (chat_id, telegram_id)
+            )
+        ''')
+        in_chunks(db, 'users', 'INSERT OR IGNORE INTO users_by_chat '
+                               'SELECT :chat, telegram_id, username, shares, is_admin, created_at FROM users '
+                               'WHERE rowid >= :lo AND rowid < :hi', {'chat': owner})
+        db.execute('DROP TABLE users')
+        db.execute('ALTER TABLE users_by_chat RENAME TO users')
+
+    # A user is now only unique within a chat, so participation can't point at users(telegram_id) anymore
+    if any(row[2] == 'users' for row in db.execute('PRAGMA foreign_key_list(participation)')):
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS participation_by_chat (
+                telegram_id INTEGER NOT NULL,
+                bounty_id INTEGER NOT NULL,
+                FOREIGN KEY(bounty_id) REFERENCES bounties(bounty_id)
+            )
+        ''')
+        in_chunks(db, 'participation', 'INSERT OR IGNORE INTO participation_by_chat (rowid, telegram_id, bounty_id) '
+                                       'SELECT rowid, telegram_id, bounty_id FROM participation '
+                                       'WHERE rowid >= :lo AND rowid < :hi')
+        db.execute('DROP TABLE participation')
+        db.execute('ALTER TABLE participation_by_chat RENAME TO participation')
+        db.execute('CREATE UNIQUE INDEX participation_bounty_user ON participation(bounty_id, telegram_id)')
+
+    if 'chat_id' not in columns(db, 'log'):
+        db.execute('ALTER TABLE log ADD COLUMN chat_id INTEGER')
+    in_chunks(db, 'log', 'UPDATE log SET chat_id = :chat WHERE rowid >= :lo AND rowid < :hi AND chat_id IS NULL',
+              {'chat': owner})
+    db.execute('DROP INDEX IF EXISTS log_to_at')
+    db.execute('CREATE INDEX IF NOT EXISTS log_chat_to_at ON log(chat_id, to_id, at DESC)')
+
+    if 'chat_id' not in columns(db, 'settings'):
+        db.execute('''
+            CREATE TABLE settings_by_chat (
+                setting_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                setting_name VARCHAR(50) NOT NULL,
+                setting_value VARCHAR(255) NOT NULL,
+                UNIQUE (chat_id, setting_name)
+            )
+        ''')
+        db.execute('INSERT INTO settings_by_chat SELECT setting_id, ?, setting_name, setting_value FROM settings',
+                   (owner,))
+        db.execute('DROP TABLE settings')
+        db.execute('ALTER TABLE settings_by_chat RENAME TO settings')
+
+def migration_update_log(db: sqlite3.Connection):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS updates (
+            update_id INTEGER PRIMARY KEY NOT NULL,
+            received_at DATE NOT NULL
+        )
+    ''')
+
+def migration_balance_snapshots(db: sqlite3.Connection):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            chat_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            shares INTEGER NOT NULL,
+            through_rowid INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, telegram_id)
+        )
+    ''')
+
+def migration_log_archive(db: sqlite3.Connection):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS log_segments (
+            segment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path VARCHAR(255) NOT NULL,
+            first_rowid INTEGER NOT NULL,
+            last_rowid INTEGER NOT NULL,
+            entries INTEGER NOT NULL,
+            created_at DATE NOT NULL
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS log_segment_users (
+            chat_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            segment_id INTEGER NOT NULL,
+            entries INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, telegram_id, segment_id)
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS log_daily (
+            chat_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            action VARCHAR(20) NOT NULL,
+            entries INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, telegram_id, day, action)
+        )
+    ''')
+
+def migration_roles(db: sqlite3.Connection):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS roles (
+            chat_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            role VARCHAR(20) NOT NULL,
+            granted_at DATE NOT NULL,
+            PRIMARY KEY (chat_id, role, telegram_id)
+        )
+    ''')
+
+    # Whoever the old checks let in keeps their access: the is_admin column and the hardcoded usernames
+    for role, names in (('admin', admin_usernames), ('dev', dev_usernames)):
+        names = [name.lstrip('@') for name in names]
+        db.execute(f"INSERT OR IGNORE INTO roles (chat_id, telegram_id, role, granted_at) "
+                   f"SELECT chat_id, telegram_id, ?, strftime('%s', 'now') FROM users "
+                   f"WHERE username COLLATE NOCASE IN ({','.join('?' * len(names))})" +
+                   (" OR is_admin" if role == 'admin' else ''), (role, *names))
+
+def migration_settlements(db: sqlite3.Connection):
+    if 'pool' not in columns(db, 'bounties'):
+        db.execute('ALTER TABLE bounties ADD COLUMN pool INTEGER NOT NULL DEFAULT 0')
+    if 'settlement' not in columns(db, 'bounties'):
+        db.execute('ALTER TABLE bounties ADD COLUMN settlement VARCHAR(10)')
+    db.execute("CREATE INDEX IF NOT EXISTS bounties_pending ON bounties(bounty_id) WHERE settlement = 'pending'")
+
+    # One row per paid bounty; its primary key is what stops a bounty being paid twice
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS settlements (
+            bounty_id INTEGER PRIMARY KEY,
+            pool INTEGER NOT NULL,
+            participants INTEGER NOT NULL,
+            settled_at DATE NOT NULL
+        )
+    ''')
+
+def migration_log_daily_trigger(db: sqlite3.Connection):
+    # log_daily so far only holds archived rows; from here on every row is counted as it's written instead
+    db.execute('''
+        INSERT INTO log_daily (chat_id, telegram_id, day, action, entries, amount)
+        SELECT chat_id, to_id, date(at, 'unixepoch'), action, COUNT(*), SUM(amount) FROM log
+        WHERE TRUE GROUP BY chat_id, to_id, date(at, 'unixepoch'), action
+        ON CONFLICT (chat_id, telegram_id, day, action) DO UPDATE SET
+            entries = entries + excluded.entries, amount = amount + excluded.amount
+    ''')
+    # A trigger, so every way a log row gets in (add_log, executemany batches, settlements) is counted in the
+    # same transaction; archiving deletes rows but leaves their totals
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS log_daily_count AFTER INSERT ON log BEGIN
+            INSERT INTO log_daily (chat_id, telegram_id, day, action, entries, amount)
+            VALUES (NEW.chat_id, NEW.to_id, date(NEW.at, 'unixepoch'), NEW.action, 1, NEW.amount)
+            ON CONFLICT (chat_id, telegram_id, day, action) DO UPDATE SET
+                entries = entries + 1, amount = amount + excluded.amount;
+        END
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS log_daily_chat_day ON log_daily(chat_id, day)')
+
+def owner_chat(db: sqlite3.Connection):
+    if primary_chat_id:
+        return int(primary_chat_id)
+
+    chat_ids = [row[0] for row in db.execute('SELECT DISTINCT chat_id FROM bounties WHERE chat_id IS NOT NULL LIMIT 2')]
+    if len(chat_ids) == 1:
+        return chat_ids[0]
+
+    if any(db.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() for table in ('users', 'bounties', 'log', 'settings')):
+        raise EnvironmentError('Set PRIMARY_CHAT_ID to the group this database belongs to!')
+
+    # Nothing to assign
+    return None
+
+def columns(db: sqlite3.Connection, table):
+    return [row[1] for row in db.execute(f'PRAGMA table_info({table})')]
+
+migrations = [
+    (1, 'base schema', migration_base_schema),
+    (2, 'bounties.chat_id', migration_bounty_chat),
+    (3, 'log, bounty and participation indexes', migration_indexes),
+    (4, 'repair bounties ended by the old remove_bounty', migration_repair_ended_bounties),
+    (5, 'per-chat users, settings and log', migration_partition_by_chat),
+    (6, 'handled webhook updates', migration_update_log),
+    (7, 'balance snapshots', migration_balance_snapshots),
+    (8, 'log archive segments and daily totals', migration_log_archive),
+    (9, 'roles', migration_roles),
+    (10, 'bounty settlement', migration_settlements),
+    (11, 'log_daily kept up to date on every write', migration_log_daily_trigger),
+    (12, 'close bounties that timed out under the old bot', migration_close_timed_out_bounties),
+]
+
+def in_chunks(db: sqlite3.Connection, table, statement, params=None):
+    """
+    Run statement over table in rowid ranges (bound to :lo and :hi, next to any params), committing between chunks
+    so a big table doesn't hold the write lock for the whole migration. Steps using this must be safe to re-run.
+    """
+    lo, last = db.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {table}').fetchone()
+
+    # Ranges hold migration_chunk_size rows each; rowids can be sparse (users are keyed by telegram_id)
+    while lo is not None:
+        row = db.execute(f'SELECT rowid FROM {table} WHERE rowid >= ? ORDER BY rowid LIMIT 1 OFFSET ?',
+                         (lo, migration_chunk_size)).fetchone()
+        hi = row[0] if row else last + 1
+
+        db.execute(statement, {**(params or {}), 'lo': lo, 'hi': hi})
+        db.execute('COMMIT')
+        db.execute('BEGIN IMMEDIATE')
+        lo = row[0] if row else None
+
+def migrate(db: sqlite3.Connection):
+    """
+    Apply every migration newer than the database's user_version, each in its own transaction together with the
+    version bump. Returns (version, name, seconds) for each step applied.
+    """
+    current = db.execute('PRAGMA user_version').fetchone()[0]
+    applied = []
+
+    for version, name, step in migrations:
+        if version <= current:
+            continue
+
+        started = time.perf_counter()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            step(db)
+            db.execute(f'PRAGMA user_version = {version}')
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+        applied.append((version, name, time.perf_counter() - started))
+
+    return applied
+
+def dry_run_migrations(path):
+    # Run pending migrations against a throwaway copy and report how long each step took
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, 'migrate.db')
+        source, target = sqlite3.connect(path), sqlite3.connect(copy, isolation_level=None)
+        try:
+            source.backup(target)
+            print(f"{path} is at schema version {target.execute('PRAGMA user_version').fetchone()[0]}")
+
+            for version, name, seconds in migrate(target):
+                print(f"{version:>4} | {name.ljust(50)} | {seconds:.3f}s")
+        finally:
+            source.close()
+            target.close()
+
+def setup(db: sqlite3.Connection):
+    for version, name, seconds in migrate(db):
+        logger.info('migration applied', extra={'fields': {'version': version, 'name': name, 'seconds': seconds}})
+
+def load_expiry():
+    global expiry_since
+
+    # Chats are loaded by chat_scope() as they're used; all that's needed up front is when open bounties run out.
+    # Any that are already past due are still closed (and their pool paid out), just not announced to the chat.
+    expiry_since = now()
+    rows = read_query("SELECT endtime, chat_id, bounty_id FROM bounties WHERE is_active = TRUE")
+    with expiry_cv:
+        expiry_heap.extend(tuple(row) for row in rows if owns_chat(row['chat_id']))
+        heapq.heapify(expiry_heap)
+
+@contextlib.contextmanager
+def chat_scope(chat_id):
+    state = open_chat(chat_id)
+    token = current_chat.set(state)
+    try:
+        yield state
+    finally:
+        current_chat.reset(token)
+        with chats_lock:
+            state['in_use'] -= 1
+            if state['stale'] and not state['in_use'] and chats.get(chat_id) is state:
+                del chats[chat_id]
+
+def open_chat(chat_id):
+    """
+    Returns the chat's state, loading it if needed, with in_use taken. Loading happens outside chats_lock so other
+    chats aren't held up; anyone else after the same chat waits for that one load. While it's loading nobody has the
+    chat open, so no writes to it are in flight and what's read is current.
+    """
+    while True:
+        with chats_lock:
+            if (state := chats.get(chat_id)) is not None:
+                state['in_use'] += 1
+                break
+            if (loaded := chats_loading.get(chat_id)) is None:
+                loaded = chats_loading[chat_id] = threading.Event()
+                break
+
+        loaded.wait()
+
+    if state is None:
+        try:
+            state = load_chat(chat_id)
+            state['in_use'] = 1  # Taken before it's published, so it can't be evicted before we get to use it
+        finally:
+            with chats_lock:
+                del chats_loading[chat_id]
+                if state is not None:
+                    chats[chat_id] = state
+            loaded.set()  # Waiters look again; if the load failed, one of them tries it
+
+    with chats_lock:
+        chats.move_to_end(chat_id)
+
+        if (excess := len(chats) - max_open_chats) > 0:
+            idle = [key for key, other in chats.items() if not other['in_use']]
+            for key in idle[:excess]:
+                del chats[key]
+
+    return state
+
+def load_chat(chat_id):
+    # Only what's live is loaded; ended bounties come in through historical_bounty() when asked for
+    state = new_runtime(chat_id)
+    token = current_chat.set(state)
+    try:
+        for row in read_query("SELECT * FROM bounties WHERE chat_id = ? AND is_active = TRUE", (chat_id,)):
+            index_bounty(Bounty.from_row(row))
+
+        for row in read_query('SELECT * FROM users WHERE chat_id = ?', (chat_id,)):
+            index_user(User.from_row(row))
+
+        for row in read_query('SELECT p.* FROM participation p INNER JOIN bounties b ON b.bounty_id = p.bounty_id '
+                              'WHERE b.chat_id = ? AND b.is_active = TRUE ORDER BY p.rowid', (chat_id,)):
+            state['participation'][row['bounty_id']][row['telegram_id']] = None
+
+        for row in read_query('SELECT telegram_id, role FROM roles WHERE chat_id = ?', (chat_id,)):
+            state['roles'][row['role']].add(row['telegram_id'])
+
+        for row in read_query('SELECT * FROM settings WHERE chat_id = ?', (chat_id,)):
+            try:
+                setattr(state['settings'], row['setting_name'], parse_setting(row['setting_name'], row['setting_value']))
+            except (KeyError, ValueError) as e:
+                # Saved before settings were checked; the default stands until an admin sets it again
+                logger.warning('setting ignored', exc_info=e,
+                               extra={'fields': {'setting': row['setting_name'], 'value': row['setting_value']}})
+    finally:
+        current_chat.reset(token)
+
+    return state
+
+def prepare_database(path):
+    db = sqlite3.connect(path, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode = WAL')  # Persistent; readers no longer block on the writer
+    try:
+        setup(db)
+    finally:
+        db.close()
+
+def open_database(path):
+    global writer, archive_root
+
+    prepare_database(path)
+    archive_root = archive_dir or os.path.join(os.path.dirname(os.path.abspath(path)), 'log-archive')
+
+    writer = threading.Thread(target=writer_loop, args=(path,), name='db-writer', daemon=True)
+    writer.start()
+
+    uri = pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+    for _ in range(read_pool_size):
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        read_pool.put(conn)
+
+    load_expiry()
+    resume_settlements()
+
+def close_database():
+    if writer is not None and writer.is_alive():
+        write_queue.put(None)
+        writer.join()
+
+    while not read_pool.empty():
+        read_pool.get_nowait().close()
+
+def run_async():
+    global async_bot, api_errors
+
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    if api_url:
+        asyncio_helper.API_URL = api_url
+    api_errors += (asyncio_helper.ApiTelegramException,)
+
+    async_bot = AsyncTeleBot(API_TOKEN, parse_mode='Markdown')
+    # Handlers stay synchronous; SQLite and in-memory work happen on this pool instead of the event loop
+    executor = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix='handler')
+
+    def wrap(f):
+        async def handler(message):
+            await asyncio.get_running_loop().run_in_executor(executor, f, message)
+
+        return handler
+
+    for handler in bot.message_handlers:
+        async_bot.register_message_handler(wrap(handler['function']), **handler['filters'])
+
+    async def main():
+        global event_loop
+
+        event_loop = asyncio.get_running_loop()
+        try:
+            await async_bot.infinity_polling()
+        finally:
+            event_loop = None
+            await async_bot.close_session()
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+class LogContext(logging.Filter):
+    # Runs on the thread that logged, the only one that can see the chat; anything costly waits for the listener
+    def filter(self, record):
+        record.event = record.getMessage()
+        record.chat_id = state['chat_id'] if (state := current_chat.get(None)) is not None else None
+        record.error_type = record.exc_info[0].__name__ if record.exc_info else None
+        return True
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    # The queue never leaves this process, so records go on it as they are, exception and all. QueueHandler would
+    # format them first, on the thread that logged.
+    def prepare(self, record):
+        return record
+
+def error_text(record):
+    return ''.join(traceback.format_exception_only(record.exc_info[1])).strip() if record.exc_info else None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'at'    : datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level' : record.levelname,
+            'event' : record.event,
+            'thread': record.threadName
+        }
+        if record.chat_id is not None:
+            entry['chat_id'] = record.chat_id
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            # The file and the console share the traceback, the way logging.Formatter caches it
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            entry['error'] = error_text(record)
+            entry['traceback'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+class AlertHandler(logging.Handler):
+    """
+    DMs the owners and the chat's devs about errors. The first of a kind (same chat, event and exception type) goes
+    out right away, as long as fewer than alert_limit have in the current window; repeats are counted and summed up
+    when its window closes.
+    """
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.windows = {}  # (chat_id, event, error_type) -> {'count', 'sent', 'error', 'timer'}
+        self.sent = deque()  # When recent immediate DMs went out; self.lock is the RLock Handler already has
+
+    def emit(self, record):
+        key = (record.chat_id, record.event, record.error_type)
+        with self.lock:
+            if (window := self.windows.get(key)) is not None:
+                window['count'] += 1
+                window['error'] = error_text(record)
+                return
+
+            clock = time.monotonic()
+            while self.sent and self.sent[0] < clock - alert_window:
+                self.sent.popleft()
+
+            timer = threading.Timer(alert_window, self.close_window, (key,))
+            timer.daemon = True
+            window = self.windows[key] = {'count': 1, 'sent': len(self.sent) < alert_limit,
+                                          'error': error_text(record), 'timer': timer}
+            if window['sent']:
+                self.sent.append(clock)
+            timer.start()
+
+        if window['sent']:
+            alert(f"⚠️ Just so you know, I had an issue with `{record.event}`", window['error'], record.chat_id)
+
+    def close_window(self, key):
+        with self.lock:
+            if (window := self.windows.pop(key, None)) is None:
+                return
+            window['timer'].cancel()
+
+        if window['count'] > window['sent']:
+            alert(f"⚠️ `{key[1]}` failed {pluralize(window['count'], 'time')} in the last "
+                  f"{display_time(int(alert_window))}. The last one was", window['error'], key[0])
+
+    def close(self):
+        # Whatever is still being counted goes out now rather than never
+        for key in list(self.windows):
+            self.close_window(key)
+        super().close()
+
+def alert(text, error, chat_id):
+    # Owners hear about every error; a chat's devs only about that chat's, since any chat can make its own devs
+    if writer is None or not writer.is_alive():
+        return
+
+    devs = set()
+    if chat_id is not None and (devs := dev_recipients.get(chat_id)) is None:
+        devs = {row['telegram_id'] for row in
+                read_query("SELECT telegram_id FROM roles WHERE chat_id = ? AND role = 'dev'", (chat_id,))}
+        # Unless /role got there first with a newer list
+        with state_lock:
+            devs = dev_recipients.setdefault(chat_id, devs)
+    text += f":\n```\n{error.replace('`', '')}\n```" if error else '.'
+    for telegram_id in sorted(devs | owner_ids):
+        enqueue({'chat_id': telegram_id, 'reply_to': None, 'text': text, 'kwargs': {}, 'alert': True})
+
+def start_logging(path):
+    global log_listener, alerts
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=log_max_bytes, backupCount=log_backups,
+                                                        encoding='utf-8')
+    console = logging.StreamHandler()
+    formatter = JsonFormatter()
+    for handler in (file_handler, console):
+        handler.setFormatter(formatter)
+    alerts = AlertHandler()
+
+    queue_handler = LocalQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(LogContext())
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    log_listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console, alerts,
+                                                  respect_handler_level=True)
+    log_listener.start()
+
+def stop_logging():
+    global log_listener
+
+    if log_listener is None:
+        return
+
+    listener, log_listener = log_listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    logger.handlers.clear()
+
+def command_metrics(name):
+    # Call with metrics_lock held
+    if (entry := metrics['commands'].get(name)) is None:
+        entry = metrics['commands'][name] = {'count': 0, 'errors': 0, 'seconds': 0, 'parse': 0, 'db': 0, 'send': 0,
+                                             'buckets': [0] * (len(latency_buckets) + 1)}
+    return entry
+
+def record_command(name, seconds, timings, failed):
+    with metrics_lock:
+        entry = command_metrics(name)
+        entry['count'] += 1
+        entry['errors'] += failed
+        entry['seconds'] += seconds
+        for phase in ('parse', 'db'):
+            entry[phase] += timings[phase]
+        entry['buckets'][bisect.bisect_left(latency_buckets, seconds)] += 1
+
+def record_statement(query, seconds):
+    if not metrics_enabled:
+        return
+
+    with metrics_lock:
+        if (entry := metrics['statements'].get(query)) is None:
+            entry = metrics['statements'][query] = [0, 0]
+        entry[0] += 1
+        entry[1] += seconds
+
+def record_send(seconds, failed, command=None):
+    if not metrics_enabled:
+        return
+
+    with metrics_lock:
+        sends = metrics['sends']
+        sends['count'] += 1
+        sends['errors'] += failed
+        sends['seconds'] += seconds
+        if command is not None:
+            command_metrics(command)['send'] += seconds
+
+def label(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def render_metrics():
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{suffix} {value}" for suffix, value in samples)
+
+    with metrics_lock:
+        commands = {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in metrics['commands'].items()}
+        statements = {query: list(entry) for query, entry in metrics['statements'].items()}
+        sends = dict(metrics['sends'])
+
+    metric('thugs_commands_total', 'counter',
+           [(f"{{command={label(name)}}}", entry['count']) for name, entry in commands.items()])
+    metric('thugs_command_errors_total', 'counter',
+           [(f"{{command={label(name)}}}", entry['errors']) for name, entry in commands.items()])
+    metric('thugs_command_phase_seconds_total', 'counter',
+           [(f"{{command={label(name)},phase={label(phase)}}}", entry[phase])
+            for name, entry in commands.items() for phase in ('parse', 'db', 'send')])
+
+    histogram = []
+    for name, entry in commands.items():
+        cumulative = 0
+        for bound, count in zip(latency_buckets + ('+Inf',), entry['buckets']):
+            cumulative += count
+            histogram.append((f"_bucket{{command={label(name)},le={label(bound)}}}", cumulative))
+        histogram.append((f"_sum{{command={label(name)}}}", entry['seconds']))
+        histogram.append((f"_count{{command={label(name)}}}", entry['count']))
+    metric('thugs_command_seconds', 'histogram', histogram)
+
+    metric('thugs_sqlite_statements_total', 'counter',
+           [(f"{{statement={label(' '.join(query.split()))}}}", count) for query, (count, _) in statements.items()])
+    metric('thugs_sqlite_statement_seconds_total', 'counter',
+           [(f"{{statement={label(' '.join(query.split()))}}}", seconds) for query, (_, seconds) in statements.items()])
+
+    metric('thugs_telegram_sends_total', 'counter', [('', sends['count'])])
+    metric('thugs_telegram_send_errors_total', 'counter', [('', sends['errors'])])
+    metric('thugs_telegram_send_seconds_total', 'counter', [('', sends['seconds'])])
+    metric('thugs_open_chats', 'gauge', [('', len(chats))])
+    metric('thugs_write_queue_depth', 'gauge', [('', write_queue.qsize())])
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    server = http.server.ThreadingHTTPServer((metrics_listen, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+class SqliteUpdateLog:
+    # Remembers handled update_ids in the bot's own database; fine while every worker shares the one file
+    def __init__(self):
+        self.added = 0
+
+    def seen(self, update_id):
+        try:
+            persist(("INSERT INTO updates (update_id, received_at) VALUES (?, ?);", (update_id, now())))
+        except sqlite3.IntegrityError:
+            return True
+
+        self.added += 1
+        if self.added % update_log_prune_every == 0:
+            persist(("DELETE FROM updates WHERE received_at < ?;", (now() - update_log_ttl,)))
+
+        return False
+
+class RedisUpdateLog:
+    # Keeps the update log out of the database. Any server speaking SET NX EX will do; bench.py webhook --update-log
+    # redis runs the workers against a stand-in one.
+    def __init__(self, client):
+        self.client = client
+
+    def seen(self, update_id):
+        return not self.client.set(f'thugs:update:{update_id}', 1, nx=True, ex=update_log_ttl)
+
+def open_update_log():
+    if update_log_url.startswith(('redis://', 'rediss://')):
+        import redis
+
+        return RedisUpdateLog(redis.Redis.from_url(update_log_url))
+
+    return SqliteUpdateLog()
+
+def update_chat(update):
+    # Chat an update belongs to, for picking its worker; updates without one all go to worker 0
+    if not isinstance(update, dict):
+        raise ValueError('update is not an object')
+
+    chat_id = 0
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+                'chat_member', 'chat_join_request'):
+        if key in update:
+            chat_id = update[key]['chat']['id']
+            break
+    else:
+        if 'message' in (callback := update.get('callback_query', {})):
+            chat_id = callback['message']['chat']['id']
+
+    if not isinstance(chat_id, int):
+        raise ValueError('chat id is not an integer')
 
-    cursor = db.cursor()
-    cursor.execute('SELECT * FROM users')
-    for row in cursor.fetchall():
-        runtime['users'][row['telegram_id']] = dict(row)
+    return chat_id
 
-    cursor = db.cursor()
-    cursor.execute('SELECT * FROM participation')
-    for row in cursor.fetchall():
-        runtime['participation'][row['bounty_id']] += [row['telegram_id']]
+def webhook_worker(index, count, updates):
+    global worker_index, worker_count
 
-    cursor = db.cursor()
-    cursor.execute('SELECT * FROM settings')
-    for row in cursor.fetchall():
-        runtime['settings'][row['setting_name']] = row['setting_value']
+    worker_index, worker_count = index, count
+    try:
+        # Rotating one file from several processes loses lines, so each worker has its own
+        start_logging('{0}-{2}{1}'.format(*os.path.splitext(log_path), index))
+        open_database(db_path)
+        start_scheduler()
+        start_dispatcher()
+        update_log = open_update_log()
+        if index == 0:
+            # Maintenance works on every chat's rows, so only one worker does it
+            start_maintenance()
+        if metrics_port:
+            # One scrape target per worker
+            start_metrics_server(metrics_port + index)
+
+        while (body := updates.get()) is not None:
+            try:
+                update = telebot.types.Update.de_json(body)
+            except Exception as e:
+                # Valid JSON with a chat, but not an update telebot can read
+                logger.warning('bad update', exc_info=e)
+                continue
+
+            try:
+                # Marked before it's handled: an update that fails halfway is dropped rather than applied twice
+                if update_log.seen(update.update_id):
+                    continue
+            except Exception as e:
+                logger.error('update log', exc_info=e)
+                continue
+
+            bot.process_new_updates([update])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        script_exit()
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    queues = []
+
+    def do_POST(self):
+        if webhook_secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook_secret:
+            return self.answer(403)
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            chat_id = update_chat(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            return self.answer(400)
+
+        # Answer right away; Telegram holds back the chat's next update until this one is acknowledged
+        self.queues[chat_id % len(self.queues)].put(body.decode())
+        self.answer(200)
+
+    def answer(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def run_webhook():
+    start_logging(log_path)
+
+    # Migrate once up front so the workers don't race each other to it
+    prepare_database(db_path)
+
+    # Spawned rather than forked: TeleBot's handler threads don't survive a fork
+    context = multiprocessing.get_context('spawn')
+    WebhookHandler.queues = [context.Queue() for _ in range(webhook_workers)]
+    workers = [context.Process(target=webhook_worker, args=(i, webhook_workers, updates), name=f'worker-{i}')
+               for i, updates in enumerate(WebhookHandler.queues)]
+    for worker in workers:
+        worker.start()
+
+    if webhook_url:
+        bot.set_webhook(url=webhook_url, secret_token=webhook_secret)
+
+    server = http.server.ThreadingHTTPServer((webhook_listen, webhook_port), WebhookHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for updates in WebhookHandler.queues:
+            updates.put(None)
+        for worker in workers:
+            worker.join()
+        stop_logging()
+
+def enqueue(item):
+    if (timings := request_timings.get()) is not None:
+        # Sent on behalf of a command: its send time counts toward it, and a general_error reply means it failed
+        item['command'] = timings['command']
+        timings['failed'] |= item['text'] == strings['general_error']
+
+    if dispatcher is None:
+        # Nothing to pace against (scripts, a bot that isn't polling); just send it
+        return transmit(item)
+
+    with outbox_cv:
+        chat = outbox.setdefault(item['chat_id'], {'queue': deque(), 'tokens': chat_burst, 'updated': time.monotonic(),
+                                                   'rate': group_rate if item['chat_id'] < 0 else chat_rate,
+                                                   'blocked_until': 0, 'busy': False})
+        if key := item.get('coalesce'):
+            if pending := next((x for x in chat['queue'] if x.get('coalesce') == key), None):
+                pending['parts'].append(item['parts'][0])
+                return
+
+            item['not_before'] = time.monotonic() + coalesce_window
+
+        item.setdefault('not_before', 0)
+        item['attempts'] = 0
+        chat['queue'].append(item)
+        outbox_cv.notify()
+
+def transmit(item):
+    text = item['render'](item['parts']) if item.get('coalesce') else item['text']
+    started = time.perf_counter()
+    failed = True
+
+    try:
+        if event_loop is None:
+            if item.get('photo') is not None:
+                result = bot.send_photo(item['chat_id'], item['photo'], caption=text, **item['kwargs'])
+            elif item['reply_to'] is not None:
+                result = bot.reply_to(item['reply_to'], text, **item['kwargs'])
+            else:
+                result = bot.send_message(item['chat_id'], text, **item['kwargs'])
+        else:
+            if item.get('photo') is not None:
+                coro = async_bot.send_photo(item['chat_id'], item['photo'], caption=text, **item['kwargs'])
+            elif item['reply_to'] is not None:
+                coro = async_bot.reply_to(item['reply_to'], text, **item['kwargs'])
+            else:
+                coro = async_bot.send_message(item['chat_id'], text, **item['kwargs'])
+            result = asyncio.run_coroutine_threadsafe(coro, event_loop).result()
+
+        failed = False
+        return result
+    finally:
+        record_send(time.perf_counter() - started, failed, item.get('command'))
+
+def next_ready():
+    # Returns (chat, item) for the next message allowed out, or (None, seconds until one might be)
+    clock = time.monotonic()
+    wait = None
+
+    for chat_id in list(outbox):
+        chat = outbox[chat_id]
+        chat['tokens'] = min(chat_burst, chat['tokens'] + (clock - chat['updated']) * chat['rate'])
+        chat['updated'] = clock
+
+        if chat['busy']:
+            continue
+
+        if not chat['queue']:
+            if chat['tokens'] >= chat_burst:
+                del outbox[chat_id]
+            continue
+
+        ready_at = max(chat['blocked_until'], min(item['not_before'] for item in chat['queue']))
+        if chat['tokens'] < 1:
+            ready_at = max(ready_at, clock + (1 - chat['tokens']) / chat['rate'])
+
+        if ready_at <= clock:
+            # Oldest sendable message first; coalescing messages wait out their window without holding up the rest
+            return chat, next(item for item in chat['queue'] if item['not_before'] <= clock)
+
+        wait = ready_at - clock if wait is None else min(wait, ready_at - clock)
+
+    return None, wait
+
+def deliver(chat, item):
+    try:
+        transmit(item)
+    except api_errors as e:
+        if e.error_code == 429:
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            with outbox_cv:
+                chat['blocked_until'] = time.monotonic() + retry_after
+                chat['queue'].appendleft(item)
+        elif e.error_code >= 500:
+            retry(chat, item, e)
+        else:
+            logger.warning('send rejected', exc_info=e)
+    except Exception as e:
+        # Network trouble; worth another go
+        retry(chat, item, e)
+    finally:
+        with outbox_cv:
+            chat['busy'] = False
+            outbox_cv.notify()
+
+def retry(chat, item, error):
+    if item['attempts'] >= send_retries:
+        # A failed alert only gets a warning, or a Telegram outage would keep alerting about itself
+        (logger.warning if item.get('alert') else logger.error)('send failed', exc_info=error)
+        return
+
+    item['attempts'] += 1
+    with outbox_cv:
+        item['not_before'] = time.monotonic() + 2 ** item['attempts']
+        chat['queue'].appendleft(item)
+
+def dispatcher_loop():
+    while True:
+        with outbox_cv:
+            while (ready := next_ready())[0] is None:
+                if dispatcher is None and not any(chat['queue'] or chat['busy'] for chat in outbox.values()):
+                    return
+                outbox_cv.wait(timeout=ready[1] if dispatcher is not None else min(ready[1] or 1, 1))
+
+            chat, item = ready
+            chat['queue'].remove(item)
+            chat['tokens'] -= 1
+            chat['busy'] = True
+
+        send_pool.submit(deliver, chat, item)
+
+def start_dispatcher():
+    global dispatcher, send_pool
+
+    send_pool = ThreadPoolExecutor(max_workers=send_threads, thread_name_prefix='sender')
+    dispatcher = threading.Thread(target=dispatcher_loop, name='dispatcher', daemon=True)
+    dispatcher.start()
+
+def stop_dispatcher(timeout=10):
+    global dispatcher
+
+    if dispatcher is None:
+        return
+
+    # Let whatever is queued go out, within reason
+    thread, dispatcher = dispatcher, None
+    with outbox_cv:
+        outbox_cv.notify()
+    thread.join(timeout)
+    send_pool.shutdown()
 
 def script_exit():
-    db.close()
+    stop_maintenance()
+    stop_scheduler()
+    stop_logging()  # Before the dispatcher and database go, so the last alert summaries still get out
+    stop_dispatcher()
+    close_database()
 
 if __name__ == "__main__":
-    try:
-        db = sqlite3.connect('thugsDB.db', check_same_thread=False)
-        db.row_factory = sqlite3.Row
+    if '--migrate-dry-run' in sys.argv:
+        dry_run_migrations(db_path)
+        sys.exit()
 
-        setup()
-        bot.infinity_polling()
+    if bot_mode == 'webhook':
+        run_webhook()
+        sys.exit()
+
+    try:
+        start_logging(log_path)
+        open_database(db_path)
+        start_scheduler()
+        start_dispatcher()
+        start_maintenance()
+        if metrics_port:
+            start_metrics_server(metrics_port)
+
+        if bot_mode == 'async':
+            run_async()
+        else:
+            bot.infinity_polling()
     finally:
         script_exit()